@@ -0,0 +1,126 @@
+import hashlib
+import os
+import zipfile
+from pathlib import Path
+import numpy as np
+
+# キャッシュを置くフォルダ．環境変数で変えられる
+CACHE_DIR_ENV = 'RAMAN_CALIBRATOR_CACHE'
+
+
+def get_cache_root() -> Path:
+    if os.environ.get(CACHE_DIR_ENV):
+        return Path(os.environ[CACHE_DIR_ENV])
+    return Path.home() / '.cache' / 'RamanCalibrator'
+
+
+# マッピングファイルを開いた結果（サイドカーキャッシュ）．使うときだけ環境変数か--sidecar-cacheで有効にする
+# 'next'なら元のファイルと同じフォルダの.raman_cache，'1'ならget_cache_root()の下，それ以外はそのフォルダに置く
+SIDECAR_ENV = 'RAMAN_CALIBRATOR_SIDECAR'
+SIDECAR_LIMIT_ENV = 'RAMAN_CALIBRATOR_SIDECAR_LIMIT'  # フォルダごとの上限 [MiB]
+SIDECAR_FOLDER = '.raman_cache'
+_sidecar_location: str | None = os.environ.get(SIDECAR_ENV) or None
+_sidecar_limit = int(float(os.environ.get(SIDECAR_LIMIT_ENV) or 8 * 2 ** 10) * 2 ** 20)
+
+
+def set_sidecar(location: str | None, max_size: int | None = None) -> None:
+    # location: None（無効），'next'，'1'，フォルダのパス．max_sizeは [byte]
+    global _sidecar_location, _sidecar_limit
+    _sidecar_location = location
+    if max_size is not None:
+        _sidecar_limit = max_size
+
+
+def get_sidecar_location() -> str | None:
+    return _sidecar_location
+
+
+def get_sidecar_limit() -> int:
+    return _sidecar_limit
+
+
+def get_sidecar(raw_path: Path) -> 'CacheManager | None':
+    # raw_pathのサイドカーキャッシュ．無効ならNone
+    if _sidecar_location is None:
+        return None
+    if _sidecar_location == 'next':
+        folder = raw_path.parent / SIDECAR_FOLDER
+    elif _sidecar_location == '1':
+        folder = get_cache_root() / 'sidecar'
+    else:
+        folder = Path(_sidecar_location)
+    return CacheManager('sidecar', _sidecar_limit, folder=folder)
+
+
+class CacheManager:  # 計算結果をディスクに保存して使い回すクラス．1件ごとに1つの.npzファイルにする
+    def __init__(self, name: str, max_size: int, folder: Path | None = None):
+        self.folder = folder if folder is not None else get_cache_root() / name
+        # 合計がこれを超えたら，最後に使ってから時間が経ったものから消す
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(*items) -> str:
+        # 配列は中身（型，形も含む），それ以外はreprからキーを作る
+        h = hashlib.sha256()
+        for item in items:
+            if isinstance(item, np.ndarray):
+                item = np.ascontiguousarray(item)
+                h.update(f'{item.dtype.str}{item.shape}'.encode())
+                h.update(item.tobytes())
+            else:
+                h.update(repr(item).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def get_path(self, key: str) -> Path:
+        return self.folder / f'{key}.npz'
+
+    def get(self, key: str) -> dict | None:
+        # 見つからない，または壊れていればNone
+        path = self.get_path(key)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as f:
+                data = {k: f[k] for k in f.files}  # f[k]は読むたびにファイルから読み出すので1回だけ読む
+            data = {k: v.item() if v.ndim == 0 else v for k, v in data.items()}
+            os.utime(path)  # 使った順に消すため
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            path.unlink(missing_ok=True)
+            return None
+        return data
+
+    def put(self, key: str, data: dict) -> None:
+        # 保存に失敗しても計算結果はそのまま使えるので，エラーにはしない
+        # 上限より大きいものは保存しない（書いてもevictですぐに消え，他のものまで消してしまう）
+        if sum(np.asarray(value).nbytes for value in data.values()) > self.max_size:
+            return
+        path = self.get_path(key)
+        tmp = path.with_name(f'{key}.{os.getpid()}.tmp')  # 複数のプロセスから同時に書いても壊れないように
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            with tmp.open('wb') as f:
+                np.savez(f, **data)
+            os.replace(tmp, path)
+            self.evict()
+        except OSError:
+            tmp.unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        files = []
+        for path in self.folder.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except OSError:  # 他のプロセスが消した
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self) -> None:
+        for path in self.folder.glob('*.npz'):
+            path.unlink(missing_ok=True)
@@ -2,16 +2,48 @@ from pathlib import Path
 import numpy as np
 from calibrator import Calibrator
 from MapManager import MapInfo
+from CacheManager import CacheManager, get_sidecar
+from utils import interpolate_xdata, float_dtype
+import instrumentation
+
+
+# サイドカーキャッシュの中身の形式．変えたら上げる（古いものは使われずに消えていく）
+SIDECAR_VERSION = 1
+
+
+class SidecarReader:  # サイドカーキャッシュから開いたとき，reader_rawの代わりに横軸だけ持っておく
+    def __init__(self, xdata: np.ndarray):
+        self.xdata = xdata
+
+    def close(self):
+        pass
+
+
+# キャリブレーション結果のディスクキャッシュ．補正した横軸とcalibration_info（文字列）だけを持ち，フィットの結果は持たない
+calibration_cache = CacheManager('calibration', 64 * 2 ** 20)
 
 
 # Calibratorは自作ライブラリ。Rayleigh, Raman用のデータとフィッティングの関数等が含まれている。
 class CalibrationManager(Calibrator):
-    def __init__(self, *args, keep_ax=False, **kwargs):
+    def __init__(self, *args, keep_ax=False, dtype=None, **kwargs):
+        # キャッシュのキーに使う設定（set_materialなどで記録する）
+        self.settings = {}
+        # 読み込んだスペクトルとそこから計算するものの浮動小数点の型（Noneなら既定の型）．MapInfoにも渡す
+        self.dtype: np.dtype = float_dtype(dtype)
         super().__init__(*args, **kwargs)
         self.reader_raw = None
         self.reader_ref = None
 
         self.is_ref_loaded = False
+        # キャッシュから読み込んだ結果かどうか（フィットの結果は持っていない）
+        self.is_cached_result = False
+        # 複数のリファレンスでドリフト補正したときの，行ごとの横軸 (行数, チャンネル)
+        self.row_xdata: np.ndarray | None = None
+        # マッピングファイルのサイドカーキャッシュと，中身が元のファイルのものか確かめるための情報
+        self.sidecar: CacheManager | None = None
+        self.sidecar_source: dict = {}
+        # サイドカーキャッシュから戻したキャリブレーションに使ったリファレンス
+        self.restored_ref_paths: list[Path] = []
 
         if not keep_ax:  # reset時にaxを保持するかどうか
             self.ax = None
@@ -22,7 +54,7 @@ class CalibrationManager(Calibrator):
         if self.ax is not None:
             self.ax.cla()
             self.ax.set_title('Reference Spectrum', fontsize=30)
-        self.__init__(keep_ax=True)
+        self.__init__(keep_ax=True, dtype=self.dtype)
 
     def reset_ref(self):
         if self.reader_raw is not None:
@@ -34,22 +66,121 @@ class CalibrationManager(Calibrator):
     def set_ax(self, ax):
         self.ax = ax
 
+    def set_material(self, material):
+        super().set_material(material)
+        self.settings['material'] = material
+
+    def set_dimension(self, dimension):
+        super().set_dimension(dimension)
+        self.settings['dimension'] = dimension
+
+    def set_function(self, function):
+        super().set_function(function)
+        self.settings['function'] = function
+
+    def calibrate(self, *args, use_cache: bool = True, **kwargs) -> bool:
+        # 同じマッピング・スペクトル・設定でキャリブレーションしたことがあれば，フィットせずにその結果を使う
+        # キーはフィットするデータ（set_dataで置いた横軸とスペクトル），マッピングの横軸（あれば），
+        # 設定（手動でアサインしたピークの範囲も含む）から作る．リファレンスを読み込まずにset_dataだけで使ってもよい
+        # キャッシュにはフィットの結果がないので，フィットし直したいときはuse_cache=Falseにする（読みも保存もしない）
+        key = cached = None
+        if use_cache:
+            key = CacheManager.make_key(
+                np.asarray(self.reader_raw.xdata) if self.reader_raw is not None else None,
+                np.asarray(self.xdata), np.asarray(self.ydata),
+                sorted(self.settings.items()), args, sorted(kwargs.items()))
+            cached = calibration_cache.get(key)
+        if cached is not None:
+            self.xdata = cached['xdata']
+            self.calibration_info = cached['calibration_info']
+            self.is_calibrated = True
+            self.is_cached_result = True
+            return True
+        self.is_cached_result = False
+        ok = super().calibrate(*args, **kwargs)
+        if ok and use_cache:
+            calibration_cache.put(key, {'xdata': self.xdata, 'calibration_info': str(self.calibration_info)})
+        return ok
+
     def load_raw(self, p: Path) -> [bool, MapInfo]:
         pass
 
+    def open_sidecar(self, p: Path) -> None:
+        # 有効なら，マッピングファイルpのサイドカーキャッシュを使う．パス，サイズ，更新日時（と計算の精度）が同じときだけ使う
+        self.sidecar = get_sidecar(p)
+        if self.sidecar is None:
+            return
+        stat = p.stat()
+        self.sidecar_source = {'source': str(p.resolve()), 'source_size': stat.st_size, 'source_mtime': stat.st_mtime_ns,
+                               'precision': self.dtype.name, 'version': SIDECAR_VERSION}
+
+    def load_sidecar(self, name) -> dict | None:
+        # nameの保存した結果．なければ，または元のファイルのものでなければNone
+        if self.sidecar is None:
+            return None
+        data = self.sidecar.get(CacheManager.make_key(sorted(self.sidecar_source.items()), name))
+        if data is None or any(data.get(k) != v for k, v in self.sidecar_source.items()):
+            return None
+        return data
+
+    def save_sidecar(self, name, data: dict) -> None:
+        if self.sidecar is not None:
+            self.sidecar.put(CacheManager.make_key(sorted(self.sidecar_source.items()), name), {**data, **self.sidecar_source})
+
+    def save_calibration(self, ref_paths: list[Path]) -> None:
+        # キャリブレーションの結果を，次にこのマッピングファイルを開いたときに戻せるようにしておく
+        data = {'xdata': np.asarray(self.xdata), 'calibration_info': str(self.calibration_info),
+                'ref_paths': '\n'.join(str(p.resolve()) for p in ref_paths)}
+        if self.row_xdata is not None:
+            data['row_xdata'] = self.row_xdata
+        self.save_sidecar('calibration', data)
+
+    def restore_calibration(self) -> bool:
+        # 前に保存したキャリブレーションの結果があれば戻す（フィットの結果とリファレンスのスペクトルは持っていない）
+        cached = self.load_sidecar('calibration')
+        if cached is None:
+            return False
+        self.xdata = cached['xdata']
+        self.row_xdata = cached.get('row_xdata')
+        self.calibration_info = cached['calibration_info']
+        self.restored_ref_paths = [Path(p) for p in cached['ref_paths'].split('\n')]
+        self.is_calibrated = True
+        self.is_cached_result = True
+        return True
+
     def load_ref(self, p: Path) -> bool:
+        # 標準サンプルのファイルを読み込んで使う
+        return self.set_ref(self.read_ref(p))
+
+    def read_ref(self, p: Path):
+        # 標準サンプルのファイルを読み込む．自分の状態は変えないので別スレッドから呼んでよい
         pass
 
-    def is_xdata_correct(self):
+    def check_ref(self, reader_ref) -> bool:
+        # マッピングと同じ条件で測定したリファレンスかどうか
+        return self.is_xdata_correct(reader_ref)
+
+    def set_ref(self, reader_ref) -> bool:
+        # read_refで読み込んだリファレンスを使う．マッピングと横軸が合わなければFalse
+        if not self.check_ref(reader_ref):
+            return False
+        self.reader_ref = reader_ref
+        self.set_data(self.reader_ref.xdata, self.reader_ref.spectra)
+        self.is_ref_loaded = True
+        return True
+
+    def is_xdata_correct(self, reader_ref=None):
+        reader_ref = reader_ref if reader_ref is not None else self.reader_ref
         if self.reader_raw is None:
             return True
         # xdataが同じかどうか確認する
-        if not np.all(self.reader_raw.xdata == self.reader_ref.xdata):
+        if not np.all(self.reader_raw.xdata == reader_ref.xdata):
             return False
         return True
 
-    def calc_xdata_diff(self):
-        diff = np.mean(np.abs(self.reader_raw.xdata - self.reader_ref.xdata))
+    def calc_xdata_diff(self, reader_ref=None):
+        reader_ref = reader_ref if reader_ref is not None else self.reader_ref
+        diff = np.mean(np.abs(self.reader_raw.xdata - reader_ref.xdata))
         return  diff
 
     def reset_data(self):
@@ -57,12 +188,37 @@ class CalibrationManager(Calibrator):
         if self.reader_raw is None or self.reader_ref is None:
             raise ValueError('Load raw data before reset.')
         self.set_data(self.reader_ref.xdata, self.reader_ref.spectra)
+        self.row_xdata = None
+
+    def calibrate_drift(self, paths: list, positions, n_rows: int, *args, use_cache: bool = True, **kwargs) -> bool:
+        # マッピングの前後などに測定した複数のリファレンスを1つずつキャリブレーションし，
+        # 各リファレンスを測定した位置（行）の間で横軸を補間する（row_xdata）
+        # xdataは最初のリファレンスで補正した横軸．マップの全点をこの横軸に揃えて使う
+        # 最後から順にキャリブレーションし，終わったときのリファレンス，スペクトル，フィットの結果が
+        # 最初のリファレンスのもの（xdataと同じもの）になるようにする．
+        # use_cache=Falseでも，フィットの結果が残らない2番目以降のリファレンスはキャッシュを使う
+        xdata_list = []
+        calibration_info = []
+        for i in reversed(range(len(paths))):
+            if self.reader_ref is not None:
+                self.reader_ref.close()
+            if not self.load_ref(paths[i]):
+                return False
+            self.reset_data()
+            if not self.calibrate(*args, use_cache=use_cache or i > 0, **kwargs):
+                return False
+            xdata_list.insert(0, np.array(self.xdata))
+            # キャッシュから読んだもの（文字列）と揃える
+            calibration_info.insert(0, str(self.calibration_info))
+        self.row_xdata = interpolate_xdata(xdata_list, positions, n_rows)
+        self.calibration_info = calibration_info
+        return True
 
     def plot(self):
         self.ax.cla()
         self.ax.set_title('Reference Spectrum', fontsize=30)
         self.ax.autoscale(True)
-        if self.is_calibrated:
+        if self.is_calibrated and not self.is_cached_result:
             self.show_result()
         else:
             self.show_spectrum()
@@ -79,3 +235,7 @@ class CalibrationManager(Calibrator):
             self.reader_raw.close()
         if self.reader_ref is not None:
             self.reader_ref.close()
+
+
+# Calibratorのフィットはcalibrateの中で計測される
+instrumentation.register(CalibrationManager, 'calibrate', 'calibrate_drift', 'load_sidecar', 'save_sidecar')
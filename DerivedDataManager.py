@@ -0,0 +1,134 @@
+import os
+import numpy as np
+
+# 元のデータと派生データ（元のデータから計算し直せる配列）の合計の上限 [byte]．環境変数（MiB）で変えられる
+# 超えたら派生データを捨てる（元のデータは捨てられないので，それだけで超えていれば派生データは毎回計算し直す）
+MEMORY_LIMIT_ENV = 'RAMAN_CALIBRATOR_MEMORY_LIMIT'
+_memory_limit = int(float(os.environ.get(MEMORY_LIMIT_ENV) or 4 * 2 ** 10) * 2 ** 20)
+
+
+def set_memory_limit(memory_limit: int) -> None:
+    # これから作るDerivedDataManagerの上限 [byte]
+    global _memory_limit
+    _memory_limit = memory_limit
+
+
+def get_memory_limit() -> int:
+    return _memory_limit
+
+
+def _buffers(value) -> list:
+    # valueが持っているメモリ（配列の元のバッファ）．ビューは元の配列として数える
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [buffer for v in value for buffer in _buffers(v)]
+    if isinstance(value, np.ndarray):
+        while isinstance(value.base, np.ndarray):
+            value = value.base
+        return [value]
+    return []
+
+
+def count_bytes(*values) -> int:
+    # 同じメモリを共有している配列は1回だけ数える
+    buffers = {id(buffer): buffer for value in values for buffer in _buffers(value)}
+    return sum(buffer.nbytes for buffer in buffers.values())
+
+
+class DerivedDataManager:  # 派生データを，何から計算したか（依存関係）と一緒にメモリ上に置いておくクラス
+    def __init__(self, memory_limit: int | None = None, graph: dict | None = None):
+        self.memory_limit = memory_limit if memory_limit is not None else get_memory_limit()
+        # 処理の段の名前 -> 入力の名前．get, putでdependsを省略したときに使う
+        self.graph: dict = graph if graph is not None else {}
+        # キーは名前か (名前, パラメータ...)．使った順に並べる（最後が最新）
+        self.entries: dict = {}
+        # キーごとの依存する名前．その名前のデータが変わったら捨てる
+        self.depends: dict = {}
+        # 上限を超えても捨てないキー（計算し直せない，または計算し直すと重いもの）
+        self.pinned: set = set()
+        # 元のデータ（map_dataなど）．メモリの集計と，依存するものを捨てる判断に使う
+        self.sources: dict = {}
+
+    @staticmethod
+    def get_name(key) -> str:
+        return key[0] if isinstance(key, tuple) else key
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def peek(self, key):
+        # 計算せずに取り出す．なければNone
+        return self.entries.get(key)
+
+    def get(self, key, compute, depends: tuple | None = None):
+        # あればそれを，なければcompute()で計算して置いておく
+        if key in self.entries:
+            self.entries[key] = self.entries.pop(key)  # 最近使ったものを後ろに回す
+            return self.entries[key]
+        value = compute()
+        self.put(key, value, depends)
+        return value
+
+    def put(self, key, value, depends: tuple | None = None, pinned: bool = False) -> None:
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        self.depends[key] = set(depends if depends is not None else self.graph.get(self.get_name(key), ()))
+        if pinned:
+            self.pinned.add(key)
+        else:
+            self.pinned.discard(key)
+        self.evict(keep=key)
+
+    def set_source(self, name: str, value) -> None:
+        # 元のデータが差し替えられたとき．同じものなら何もしない
+        if self.sources.get(name) is value:
+            return
+        self.sources[name] = value
+        self.invalidate(name)
+
+    def remove(self, key) -> None:
+        self.entries.pop(key, None)
+        self.depends.pop(key, None)
+        self.pinned.discard(key)
+
+    def invalidate(self, name: str) -> None:
+        # nameのデータが変わったので，nameと，それに（間接的にも）依存するものを捨てる
+        names = {name}
+        while True:
+            keys = [key for key in self.entries if self.get_name(key) in names or self.depends[key] & names]
+            if not keys:
+                return
+            for key in keys:
+                names.add(self.get_name(key))
+                self.remove(key)
+
+    def evict(self, keep=None) -> None:
+        # 上限を超えていれば，最も長く使われていないものから捨てる．keepと固定したもの，
+        # 元のデータとメモリを共有しているもの（捨ててもメモリが空かない）は捨てない
+        in_use = {id(buffer) for buffer in _buffers(list(self.sources.values()))}
+        while self.total_bytes() > self.memory_limit:
+            candidates = [key for key in self.entries if key != keep and key not in self.pinned
+                          and _buffers(self.entries[key]) and not {id(b) for b in _buffers(self.entries[key])} & in_use]
+            if not candidates:
+                return
+            self.remove(candidates[0])
+
+    def total_bytes(self) -> int:
+        return count_bytes(*self.sources.values(), *self.entries.values())
+
+    def report(self) -> dict:
+        # 元のデータと派生データのキーごとのバイト数．前に出てきたものとメモリを共有している分は数えない
+        result = {}
+        counted = set()
+        for key, value in list(self.sources.items()) + list(self.entries.items()):
+            buffers = [buffer for buffer in _buffers(value) if id(buffer) not in counted]
+            counted.update(id(buffer) for buffer in buffers)
+            result[key] = count_bytes(buffers)
+        return result
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.depends.clear()
+        self.pinned.clear()
+        self.sources.clear()
@@ -1,9 +1,106 @@
+import sys
 import numpy as np
 from PIL import Image
 import matplotlib
 from matplotlib.colors import Normalize
 from dataclasses import dataclass, field
-from utils import subtract_baseline
+from utils import integrate_band, integrate_bands, cumsum_spectra, integrate_band_from_cumsum, resample_spectra, float_dtype, SubtractedSpectra, \
+    ResampledSpectra
+from DerivedDataManager import DerivedDataManager
+import instrumentation
+
+# マップの横軸範囲のプリセット
+MAP_RANGE_LIST = (
+    '120~250',
+    '510~530',
+    '1350~1380',
+    '1570~1610',
+    '2550~2750',
+)
+
+
+# MapInfoの位置と大きさ（サイドカーキャッシュに保存するもの）
+MAP_GEOMETRY = ('shape', 'map_origin', 'map_pixel', 'map_size', 'img_origin', 'img_size')
+
+# 処理の流れ．段の名前 -> 入力（元のデータか前の段）の名前．入力が変わった段だけ捨てて計算し直す
+# 生データ (map_data_4d) → 積算の平均 / 宇宙線除去 → 背景 (bg_data) → 横軸 (xdata, row_xdata) → 累積和 → バンド強度マップ
+# 背景，ドリフト補正，累積和，バンド強度マップの入力はmap_dataをどの段を通って作ったかで決まる（MapInfo.stage_inputs）
+PROCESSING_GRAPH = {
+    'mean': ('map_data_4d',),
+    'mean_4d': ('map_data_4d',),
+    'std': ('map_data_4d',),
+    'crr': ('mean', 'mean_4d', 'std'),
+}
+
+
+def parse_map_range(map_range: str) -> tuple:
+    # '1570~1610' -> (1570.0, 1610.0)
+    return tuple(map(float, map_range.split('~')))
+
+
+def band_index(xdata: np.ndarray, map_range: tuple):
+    # map_rangeに入るチャンネル．連続していればslice，xdataが単調でなく連続しない場合はインデックスの配列，なければNone
+    idx = np.flatnonzero((map_range[0] < xdata) & (xdata < map_range[1]))
+    if idx.size == 0:
+        return None
+    if idx[-1] + 1 - idx[0] == idx.size:
+        return slice(idx[0], idx[-1] + 1)
+    return idx
+
+
+def image_to_array(img: Image.Image) -> np.ndarray:
+    # 光学像の配列．パレットや16bitなどの画像は，そのままでは色が変わったり縮小できなかったりするのでRGB(A)にする
+    if img.mode not in ('L', 'RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode in ('P', 'PA', 'LA') else 'RGB')
+    return np.asarray(img)
+
+
+def build_pyramid(image: np.ndarray, min_size: int = 256) -> list:
+    # 縦横1/2ずつ縮小した画像のリスト（0番目が元の画像）．2x2の平均で縮小し，短辺がmin_sizeを下回る手前まで作る
+    levels = [image]
+    while min(levels[-1].shape[:2]) >= 2 * min_size:
+        a = levels[-1]
+        ny, nx = a.shape[0] // 2 * 2, a.shape[1] // 2 * 2
+        a = a[:ny, :nx].reshape(ny // 2, 2, nx // 2, 2, *a.shape[2:]).mean(axis=(1, 3))
+        levels.append(a.round().astype(image.dtype) if np.issubdtype(image.dtype, np.integer) else a)
+    return levels
+
+
+def calc_band_maps(xdata: np.ndarray, map_data, map_ranges: list, cumsum: np.ndarray | None = None, dtype=None) -> dict:
+    # 複数の範囲のバンド強度マップをまとめて計算する．{map_range: マップ}
+    # メモリ上のデータは累積和から，ディスク上のデータは分割して1回読むだけで全ての範囲を計算する
+    if len(map_data.shape) != 3:
+        return {map_range: np.array([[]]) for map_range in map_ranges}
+    if isinstance(map_data, SubtractedSpectra):
+        # ベースラインを引いた和は線形なので，引く前のマップから背景のバンド強度を引けばよい（cumsumは引く前のもの）
+        result = calc_band_maps(xdata, map_data.data, map_ranges, cumsum=cumsum, dtype=dtype)
+        for map_range, band_map in result.items():
+            band = band_index(xdata, map_range)
+            if band is not None:
+                result[map_range] = band_map - integrate_band(map_data.offset[band], dtype)
+        return result
+    bands = {}
+    result = {}
+    for map_range in map_ranges:
+        band = band_index(xdata, map_range)
+        if band is None:
+            result[map_range] = np.array([[]])
+        else:
+            bands[map_range] = band
+    if not bands:
+        return result
+    if not isinstance(map_data, np.ndarray):
+        result.update(zip(bands, integrate_bands(map_data, list(bands.values()), dtype=dtype)))
+        return result
+    for map_range, band in bands.items():
+        # 累積和はfloat64で持つので，float32のモードでは渡されたときだけ使う（データの2倍のメモリになる）
+        if isinstance(band, slice) and (cumsum is not None or float_dtype(dtype) == np.float64):
+            if cumsum is None:
+                cumsum = cumsum_spectra(map_data)
+            result[map_range] = integrate_band_from_cumsum(cumsum, map_data, band.start, band.stop, dtype)
+        else:  # 累積和は使えない
+            result[map_range] = integrate_band(map_data[:, :, band], dtype)
+    return result
 
 
 @dataclass
@@ -18,8 +115,114 @@ class MapInfo:  # マッピングの情報をまとめたクラス，複数の
     img_origin: tuple
     img_size: tuple
     map_data_4d: np.ndarray = field(default_factory=lambda: np.array([[[[]]]]))
-    map_data_mean: np.ndarray = field(default_factory=lambda: np.array([[[]]]))
-    map_data_crr: np.ndarray = field(default_factory=lambda: np.array([[[]]]))
+    # map_dataが派生データから作ったものなら (元にした派生データのキー, 背景を引いたか[, ドリフト補正したか])．
+    # 同じ組み合わせに戻ったときに累積和やバンド強度マップを使い回すのに使う．Noneなら読み込んだまま（とそのドリフト補正）
+    map_data_key: tuple | None = None
+    # 積算の平均，宇宙線除去，累積和，バンド強度マップなどの派生データ．PROCESSING_GRAPHの入力が変わったら捨てる
+    derived: DerivedDataManager = field(default_factory=lambda: DerivedDataManager(graph=PROCESSING_GRAPH))
+    # スペクトルとそこから計算するマップの浮動小数点の型．作ったときの既定の型で，後から既定の型を変えても変わらない
+    dtype: np.dtype = field(default_factory=float_dtype)
+
+    def __post_init__(self):
+        self.dtype = np.dtype(self.dtype)
+        self.derived.set_source('map_data', self.map_data)
+        self.derived.set_source('xdata', self.xdata)
+        self.derived.set_source('map_data_4d', self.map_data_4d)
+
+    def set_map_data(self, map_data, key: tuple | None = None) -> None:
+        # map_dataを差し替えるときはこれを使う（依存する派生データを捨てる）
+        self.map_data = map_data
+        self.map_data_key = key
+        self.derived.set_source('map_data', map_data)
+
+    @staticmethod
+    def stage_inputs(map_data_key: tuple | None) -> tuple:
+        # map_data_keyのmap_dataを作るのに通った段．これらが変わったらmap_dataから計算したものを捨てる
+        if map_data_key is None:
+            return ('map_data',)
+        base, is_bg_subtracted, *is_drift_corrected = map_data_key
+        inputs = (DerivedDataManager.get_name(base),)
+        if is_bg_subtracted:
+            inputs += ('bg_data',)
+        if any(is_drift_corrected):
+            inputs += ('xdata', 'row_xdata')
+        return inputs
+
+    def get_drift_corrected(self, row_xdata: np.ndarray):
+        # 行ごとの横軸row_xdataのmap_dataをxdata上に補間し直したもの．派生データから作ったものなら組み合わせごとに使い回す
+        # ディスク上のデータは全体をメモリに作らず，読み出すときに補間する
+        data = self.map_data.data if isinstance(self.map_data, SubtractedSpectra) else self.map_data
+        if not isinstance(data, np.ndarray):
+            return ResampledSpectra(row_xdata, self.map_data, self.xdata, extrapolate=True, dtype=self.dtype)
+        if self.map_data_key is None:
+            return resample_spectra(row_xdata, self.map_data, self.xdata, extrapolate=True, dtype=self.dtype)
+        return self.derived.get(('drift', self.map_data_key),
+                                lambda: resample_spectra(row_xdata, self.map_data, self.xdata, extrapolate=True, dtype=self.dtype),
+                                depends=self.stage_inputs(self.map_data_key) + ('xdata', 'row_xdata'))
+
+    def get_cumsum(self) -> np.ndarray | None:
+        # バンド強度計算用の累積和．背景を引いたデータは引く前のものの累積和．ディスク上のデータはNone
+        # xdataの更新（キャリブレーション）はチャンネルの並びを変えないので作り直す必要はない
+        # 累積和はfloat64なので，float32のモードでは作らずにバンドごとに足す（calc_band_maps）
+        data = self.map_data.data if isinstance(self.map_data, SubtractedSpectra) else self.map_data
+        if not isinstance(data, np.ndarray) or self.dtype != np.float64:
+            return None
+        if self.map_data_key is None:
+            return self.derived.get('cumsum', lambda: cumsum_spectra(data), depends=('map_data',))
+        # 背景を引く前のデータの累積和なので，背景の段は入力に含めない
+        key = self.map_data_key if isinstance(self.map_data, np.ndarray) else (self.map_data_key[0], False)
+        return self.derived.get(('cumsum', key), lambda: cumsum_spectra(data), depends=self.stage_inputs(key))
+
+    def get_band_maps(self, map_ranges: list) -> dict:
+        # map_rangesのバンド強度マップ．通った段か横軸が変わるまで使い回す（後から増えた範囲は追加で計算する）
+        if self.map_data_key is None:
+            key, depends = 'band_maps', ('map_data', 'xdata')
+        else:
+            key, depends = ('band_maps', self.map_data_key), self.stage_inputs(self.map_data_key) + ('xdata',)
+        band_maps = self.derived.get(
+            key, lambda: calc_band_maps(self.xdata, self.map_data, map_ranges, cumsum=self.get_cumsum(), dtype=self.dtype), depends=depends)
+        missing = [map_range for map_range in map_ranges if map_range not in band_maps]
+        if missing:
+            # 置いてあるものを書き換えずに作り直して置き直す（メモリの集計と上限の判断を合わせるため）
+            band_maps = {**band_maps, **calc_band_maps(self.xdata, self.map_data, missing, cumsum=self.get_cumsum(), dtype=self.dtype)}
+            self.derived.put(key, band_maps, depends=depends)
+        return band_maps
+
+    def set_xdata(self, xdata: np.ndarray) -> None:
+        self.xdata = xdata
+        self.derived.set_source('xdata', xdata)
+
+    def update_xdata(self, xdata: np.ndarray, row_xdata: np.ndarray | None = None, uncorrected: tuple | None = None) -> tuple | None:
+        # 横軸をxdataにする．row_xdata（行ごとに補正した横軸）があればドリフト補正として，全点をxdata上に補間し直す
+        # uncorrectedは前のドリフト補正で置き換える前の (map_data, map_data_key)．戻してからやり直し，今回のものを返す
+        if uncorrected is not None:
+            self.set_map_data(*uncorrected)
+            uncorrected = None
+        self.set_xdata(xdata)
+        self.derived.set_source('row_xdata', row_xdata)
+        if row_xdata is not None:
+            uncorrected = (self.map_data, self.map_data_key)
+            key = self.map_data_key
+            self.set_map_data(self.get_drift_corrected(row_xdata), key=None if key is None else key[:2] + (True,))
+        self.derived.set_source('map_data_uncorrected', uncorrected)
+        return uncorrected
+
+    def memory_report(self) -> dict:
+        # データごとのメモリ [byte]．他と共有しているメモリは最初に出てきたものだけで数える
+        return self.derived.report()
+
+    def to_arrays(self) -> dict:
+        # サイドカーキャッシュに保存する横軸，位置と大きさ，光学像．スペクトルは呼び出し側で加える
+        data = {name: np.asarray(getattr(self, name)) for name in MAP_GEOMETRY}
+        data['xdata'] = np.asarray(self.xdata)
+        data['img'] = image_to_array(self.img)
+        return data
+
+    @classmethod
+    def from_arrays(cls, data: dict, **kwargs) -> 'MapInfo':
+        # to_arraysで保存したものから作る．map_dataなどはkwargsで渡す
+        geometry = {name: tuple(data[name].tolist()) for name in MAP_GEOMETRY}
+        return cls(xdata=data['xdata'], img=Image.fromarray(data['img']), **geometry, **kwargs)
 
 
 class MapManager:
@@ -28,18 +231,20 @@ class MapManager:
             self.ax: matplotlib.Axes = None
         self.axes_img: matplotlib.image.AxesImage = None
         self.axes_map: matplotlib.image.AxesImage = None
+        # 光学像とマップの縮小画像と，表示している段
+        self.img_pyramid: list = []
+        self.map_pyramid: list = []
+        self.img_level: int = 0
+        self.map_level: int = 0
         # RenishawCalibratorから渡される情報
         self.map_info: MapInfo
         # マップの横軸範囲
         self.map_range: tuple = (0, 0)
         # マップの横軸範囲のプリセット
-        self.map_range_list = (
-            '120~250',
-            '510~530',
-            '1350~1380',
-            '1570~1610',
-            '2550~2750',
-        )
+        self.map_range_list = MAP_RANGE_LIST
+        # ユーザーが追加した範囲．resetしても残す
+        if not keep_ax:
+            self.pinned_ranges: list = []
         # カラーマップ
         self.cmap: str = 'hot'
         # カラーマップのリスト
@@ -64,8 +269,16 @@ class MapManager:
         self.horizontal_line = None
         self.vertical_line = None
         self.show_crosshair = True
+        # 保存リストに追加した点の表示（点の数によらず1枚の画像で描く）
+        self.selection: np.ndarray | None = None
+        self.axes_selection: matplotlib.image.AxesImage = None
+        self.selection_rgba: np.ndarray | None = None
+        self.selection_scale: int = 1
+        self.show_selection = True
         # データが存在するかどうか
         self.is_loaded = False
+        # ドリフト補正する前の (map_data, map_data_key)
+        self.map_data_uncorrected = None
 
     def reset(self):
         self.__init__(keep_ax=True)
@@ -73,14 +286,18 @@ class MapManager:
     def set_ax(self, ax: matplotlib.pyplot.Axes) -> None:
         self.ax = ax
 
-    def update_xdata(self, xdata: np.ndarray) -> None:
+    def update_xdata(self, xdata: np.ndarray, row_xdata: np.ndarray | None = None) -> None:
         # キャリブレーションによって更新されたとき
-        self.map_info.xdata = xdata
+        # 横軸が前と同じもの（処理の切り替えで呼ばれたとき）なら，その段から先は計算済みのものを使う
+        self.map_data_uncorrected = self.map_info.update_xdata(xdata, row_xdata, self.map_data_uncorrected)
 
-    def load(self, map_info: MapInfo) -> None:
+    def load(self, map_info: MapInfo, map_data_uncorrected: tuple | None = None) -> None:
         # マッピングファイルを読み込む
+        # 別スレッドで累積和やバンド強度マップを作ってあれば，map_info.derivedに入っている
+        # 別スレッドでドリフト補正まで済ませてあれば，map_data_uncorrectedは補正する前の (map_data, map_data_key)
         self.map_info = map_info
         self.is_loaded = True
+        self.map_data_uncorrected = map_data_uncorrected
 
     def clear_and_show(self) -> None:
         # マップをクリア
@@ -90,8 +307,14 @@ class MapManager:
         self.show_optical_img()
         # ラマンマッピングの描画
         self.show_map()
+        # 保存リストに追加した点の描画
+        self.show_selection_overlay()
         # クロスヘアの作成
         self.create_crosshair()
+        # ズーム・移動したときに表示する解像度を選び直す（claで登録が消えるので毎回登録する）
+        self.ax.callbacks.connect('xlim_changed', self.update_pyramid_levels)
+        self.ax.callbacks.connect('ylim_changed', self.update_pyramid_levels)
+        self.update_pyramid_levels()
 
     def show_optical_img(self):
         # 光学像の位置、サイズを取り出す
@@ -101,19 +324,34 @@ class MapManager:
         y1 = self.map_info.img_origin[1] + self.map_info.img_size[1]
         self.ax.set_xlim(x0, x1)
         self.ax.set_ylim(y1, y0)
-        # 光学像を描画
-        self.axes_img = self.ax.imshow(self.map_info.img, extent=(x0, x1, y1, y0))
+        # 光学像を描画．大きな画像を毎回縮小しなくて済むよう，縮小画像を作っておく
+        self.img_pyramid = build_pyramid(image_to_array(self.map_info.img))
+        self.img_level = 0
+        self.axes_img = self.ax.imshow(self.img_pyramid[0], extent=(x0, x1, y1, y0))
+
+    def get_band_ranges(self) -> list:
+        # まとめて計算しておく範囲（プリセットと追加した範囲）
+        return [parse_map_range(map_range) for map_range in self.map_range_list] + self.pinned_ranges
+
+    def pin_map_range(self, map_range: tuple) -> None:
+        map_range = tuple(map(float, map_range))
+        if map_range not in self.get_band_ranges():
+            self.pinned_ranges.append(map_range)
+
+    def precompute_band_maps(self) -> dict:
+        # プリセットと追加した範囲のマップを全て計算しておく
+        return self.map_info.get_band_maps(self.get_band_ranges())
 
     def _calc_map_data(self):
-        if len(self.map_info.map_data.shape) != 3:
-            return np.array([[]])
         # マッピングの描画に必要なデータを計算
-        map_range_idx = (self.map_range[0] < self.map_info.xdata) & (self.map_info.xdata < self.map_range[1])
-        data = self.map_info.map_data[:, :, map_range_idx]
-        if data.shape[2] == 0:
-            return np.array([[]])
-        data = np.array([[subtract_baseline(d).sum() for d in dat] for dat in data])
-        return data
+        map_range = tuple(self.map_range)
+        if map_range in self.get_band_ranges():
+            return self.precompute_band_maps()[map_range]
+        return calc_band_maps(self.map_info.xdata, self.map_info.map_data, [map_range], cumsum=self.map_info.get_cumsum(),
+                              dtype=self.map_info.dtype)[map_range]
+
+    def memory_report(self) -> dict:
+        return self.map_info.memory_report() if self.is_loaded else {}
 
     def show_map(self):
         # マップの位置、サイズを取り出す
@@ -130,6 +368,8 @@ class MapManager:
         # カラーマップ範囲の自動調整のために値を保存しておく
         self.cmap_range_auto_result = (data.min(), data.max())
         # 光学像の上にマッピングを描画
+        self.map_pyramid = build_pyramid(data)
+        self.map_level = 0
         self.axes_map = self.ax.imshow(
             data,
             alpha=self.alpha,
@@ -144,7 +384,10 @@ class MapManager:
             data = self._calc_map_data()
             if data.shape[1] > 0 and (self.cmap_range_auto or cmap_range_auto):  # カラーマップ範囲の自動調整のために値を保存しておく
                 self.cmap_range_auto_result = (data.min(), data.max())
-            self.axes_map.set(data=data)
+            if not self.map_pyramid or data is not self.map_pyramid[0]:  # 計算済みのマップが変わっていなければ作り直さない
+                self.map_pyramid = build_pyramid(data)
+                self.map_level = self._choose_level(self.map_pyramid, self.axes_map)
+                self.axes_map.set(data=self.map_pyramid[self.map_level])
         # カラーマップ関連の設定
         self.cmap = cmap if cmap is not None else self.cmap
         self.cmap_range = cmap_range if cmap_range is not None else self.cmap_range
@@ -155,6 +398,96 @@ class MapManager:
         self.axes_map.set(alpha=self.alpha, cmap=self.cmap, norm=Normalize(vmin=self.cmap_range[0], vmax=self.cmap_range[1]))
         return self.cmap_range
 
+    def refresh_map(self) -> [float, float]:
+        # 処理やキャリブレーションでmap_dataかxdataが変わったとき，今の範囲のマップを描き直す
+        # 入力が変わっていない段は計算済みのものを使うので，変わった段から先だけ計算し直す
+        return self.update_map(map_range=self.map_range)
+
+    def _selection_block(self) -> np.ndarray:
+        # 1点分のRGBA．拡大できるときは白枠，できないときは半透明の白で塗る
+        scale = self.selection_scale
+        block = np.zeros((scale, scale, 4), dtype=np.uint8)
+        if scale >= 3:
+            block[[0, -1], :] = 255
+            block[:, [0, -1]] = 255
+        else:
+            block[:] = (255, 255, 255, 128)
+        return block
+
+    def _selection_image(self) -> np.ndarray:
+        # selectionの各点をブロックに置き換えた画像
+        ny, nx = self.selection.shape
+        scale = self.selection_scale
+        rgba = self.selection[:, None, :, None, None] * self._selection_block()[None, :, None, :, :]
+        return rgba.reshape(ny * scale, nx * scale, 4)
+
+    def show_selection_overlay(self) -> None:
+        # 各点をselection_scale倍に拡大した画像を作り，マップと同じ位置に重ねる
+        if self.selection is None or self.selection.shape != tuple(self.map_info.shape):
+            self.selection = np.zeros(self.map_info.shape, dtype=bool)
+        ny, nx = self.selection.shape
+        self.selection_scale = max(1, min(8, 2048 // max(ny, nx, 1)))
+        x0 = self.map_info.map_origin[0]
+        y0 = self.map_info.map_origin[1]
+        x1 = self.map_info.map_origin[0] + self.map_info.map_size[0]
+        y1 = self.map_info.map_origin[1] + self.map_info.map_size[1]
+        self.axes_selection = self.ax.imshow(
+            self._selection_image(),
+            extent=(x0, x1, y0, y1),
+            origin='lower',
+            interpolation='nearest',
+            visible=self.show_selection)
+        # 追加・削除のたびに作り直さず，imshowが持っている配列を直接書き換える
+        self.selection_rgba = self.axes_selection.get_array().data
+
+    def set_selection(self, selection: np.ndarray) -> None:
+        # 保存リスト全体を置き換える．SelectionManager.maskをそのまま受け取って表示に使う
+        self.selection = selection
+        if self.axes_selection is None:
+            return
+        self.selection_rgba[:] = self._selection_image()
+        self.axes_selection.changed()
+
+    def set_selected(self, row: int, col: int, selected: bool) -> None:
+        # 1点だけ追加・削除する．書き換えるのはその点の部分だけ
+        if self.selection is None:
+            self.selection = np.zeros(self.map_info.shape, dtype=bool)
+        self.selection[row, col] = selected
+        if self.axes_selection is None:
+            return
+        scale = self.selection_scale
+        self.selection_rgba[row * scale:(row + 1) * scale, col * scale:(col + 1) * scale] = self._selection_block() if selected else 0
+        self.axes_selection.changed()
+
+    def set_selection_visible(self, visible: bool) -> None:
+        self.show_selection = visible
+        if self.axes_selection is not None:
+            self.axes_selection.set_visible(visible)
+
+    def _choose_level(self, pyramid: list, axes_image: matplotlib.image.AxesImage) -> int:
+        # 表示範囲に入る画素数がaxesの画素数を下回らない範囲で，一番小さい段
+        x0, x1, y0, y1 = axes_image.get_extent()
+        xlim = self.ax.get_xlim()
+        ylim = self.ax.get_ylim()
+        bbox = self.ax.get_window_extent()
+        ny, nx = pyramid[0].shape[:2]
+        # 画面の1画素あたりの元画像の画素数
+        ratio_x = nx * abs(xlim[1] - xlim[0]) / max(abs(x1 - x0), 1e-12) / max(bbox.width, 1)
+        ratio_y = ny * abs(ylim[1] - ylim[0]) / max(abs(y1 - y0), 1e-12) / max(bbox.height, 1)
+        level = int(np.floor(np.log2(max(min(ratio_x, ratio_y), 1))))
+        return min(level, len(pyramid) - 1)
+
+    def update_pyramid_levels(self, *args) -> None:
+        # 表示範囲とaxesの大きさに合った解像度の画像に差し替える．段が変わらなければ何もしない
+        for axes_image, pyramid, attr in ((self.axes_img, self.img_pyramid, 'img_level'),
+                                          (self.axes_map, self.map_pyramid, 'map_level')):
+            if axes_image is None or len(pyramid) < 2:
+                continue
+            level = self._choose_level(pyramid, axes_image)
+            if level != getattr(self, attr):
+                setattr(self, attr, level)
+                axes_image.set_data(pyramid[level])
+
     def coord2idx(self, x_pos: float, y_pos: float) -> [int, int]:
         # 座標からインデックスに変換
         col = round((x_pos - self.map_info.map_origin[0]) // self.map_info.map_pixel[0])
@@ -213,10 +546,15 @@ class MapManager:
         return self.map_info.xdata, self.map_info.map_data[self.row, self.col]
 
     def create_crosshair(self) -> None:
-        self.horizontal_line = self.ax.axhline(color='k', lw=2, ls=(0, (5, 5)), gapcolor='w')
-        self.vertical_line = self.ax.axvline(color='k', lw=2, ls=(0, (5, 5)), gapcolor='w')
+        # クロスヘアは頻繁に動くので，背景とは別に描画する（animated）
+        self.horizontal_line = self.ax.axhline(color='k', lw=2, ls=(0, (5, 5)), gapcolor='w', animated=True)
+        self.vertical_line = self.ax.axvline(color='k', lw=2, ls=(0, (5, 5)), gapcolor='w', animated=True)
         self.update_crosshair()
 
+    def get_animated_artists(self) -> list:
+        # 背景とは別に描画するもの
+        return [line for line in (self.horizontal_line, self.vertical_line) if line is not None]
+
     def update_crosshair(self) -> None:
         # マッピング上のクロスヘアを移動
         x, y = self.idx2coord(self.row, self.col)
@@ -229,3 +567,8 @@ class MapManager:
         else:
             self.horizontal_line.set_visible(False)
             self.vertical_line.set_visible(False)
+
+
+instrumentation.register(MapManager, 'load', 'clear_and_show', 'update_map', 'refresh_map', '_calc_map_data', 'precompute_band_maps', 'update_xdata')
+instrumentation.register(MapInfo, 'get_drift_corrected', 'get_cumsum', 'get_band_maps')
+instrumentation.register(sys.modules[__name__], 'calc_band_maps')
@@ -1,59 +1,279 @@
+import sys
 from pathlib import Path
 import numpy as np
+import h5py
 from PIL import Image
 from dataloader import RamanHDFReader
-from CalibrationManager import CalibrationManager
+from CalibrationManager import CalibrationManager, SidecarReader
 from MapManager import MapInfo
-from utils import remove_cosmic_ray
+from utils import remove_cosmic_ray, spectra_std, mean_accumulations, float_dtype, as_float, SubtractedSpectra, CHUNK_MEMORY_LIMIT
+import instrumentation
+
+
+class LazyMeanCube:
+    # HDF5のスペクトル (x, y, 積算, スペクトル) をディスク上に置いたまま，
+    # 積算の平均をとった (y, x, スペクトル) の配列として必要な部分だけ読み出す
+    # offsetを指定すると読み出した後に引く（背景の引き算）
+    def __init__(self, dataset: h5py.Dataset, offset: np.ndarray | None = None, dtype=None):
+        self.dataset = dataset
+        self.offset = offset
+        self.shape = (dataset.shape[1], dataset.shape[0], dataset.shape[3])
+        self.ndim = 3
+        self.dtype = float_dtype(dtype)
+        self.nbytes = 0  # メモリ上には持たない
+
+    def __sub__(self, other: np.ndarray) -> 'LazyMeanCube':
+        offset = other if self.offset is None else self.offset + other
+        return LazyMeanCube(self.dataset, offset, self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        # 知らないうちに全体をメモリに展開しないよう，全体が必要なときは [:, :, :] と明示して読む
+        raise TypeError('LazyMeanCube is kept on disk; read it with [row, col] or explicitly with [:, :, :].')
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        row, col, channel = key + (slice(None),) * (3 - len(key))
+        if np.ndim(row) == 1 and np.ndim(col) == 1:  # 点の集まり（保存時など）
+            return np.array([self[r, c, channel] for r, c in zip(row, col)])
+        if np.ndim(channel) == 1:  # h5pyは昇順のリストしか受け付けない
+            channel = list(np.asarray(channel))
+        is_int = [isinstance(k, (int, np.integer)) for k in (col, row)]
+        is_whole = all(isinstance(k, slice) and k == slice(None) for k in (col, row))
+        if is_whole and not isinstance(channel, (int, np.integer)):  # マップ全体はチャンクごとに読む
+            data = self._read_all(channel)
+        else:
+            data = as_float(self.dataset[col, row, :, channel].mean(axis=2 - sum(is_int)), self.dtype)
+        if not any(is_int):
+            data = data.swapaxes(0, 1)
+        if self.offset is not None:
+            data = data - self.offset[channel]
+        return data
+
+    def _read_all(self, channel) -> np.ndarray:
+        nx, ny = self.dataset.shape[:2]
+        n_channel = len(range(*channel.indices(self.dataset.shape[3]))) if isinstance(channel, slice) else len(channel)
+        # HDF5のチャンクの境界に合わせてxをまとめて読む
+        bytes_per_x = ny * self.dataset.shape[2] * max(1, n_channel) * self.dataset.dtype.itemsize
+        step = max(1, CHUNK_MEMORY_LIMIT // bytes_per_x)
+        if self.dataset.chunks is not None:
+            step = max(self.dataset.chunks[0], step // self.dataset.chunks[0] * self.dataset.chunks[0])
+        data = np.empty((nx, ny, n_channel), dtype=self.dtype)
+        for x0 in range(0, nx, step):
+            data[x0:x0 + step] = self.dataset[x0:x0 + step, :, :, channel].mean(axis=2)
+        return data
+
+
+def find_spectra_dataset(f: h5py.File, shape: tuple | None = None) -> h5py.Dataset | None:
+    # 形がshapeの（Noneなら4次元の）データセットを探す．1つに決まらなければNone
+    found = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and (obj.shape == shape if shape is not None else obj.ndim == 4):
+            found.append(obj)
+    f.visititems(visit)
+    return found[0] if len(found) == 1 else None
+
+
+def read_as_float(dataset: h5py.Dataset, dtype=None) -> np.ndarray:
+    # データセット全体をas_floatと同じ型で読む．変換するときはh5pyで読みながら変換し，元の型の全体の配列は作らない
+    dtype = float_dtype(dtype)
+    if np.issubdtype(dataset.dtype, np.floating) and dataset.dtype.itemsize > dtype.itemsize:
+        return dataset.astype(dtype)[()]
+    return dataset[()]
+
+
+# RamanHDFReader.map_infoの項目
+MAP_INFO_KEYS = ('x_start', 'y_start', 'x_pad', 'y_pad', 'x_span', 'y_span')
+
+
+class LazyHDFReader:
+    # RamanHDFReaderの代わりに，スペクトル (x, y, 積算, スペクトル) をディスク上に置いたまま横軸と測定範囲だけ読む
+    # 4次元のデータセットが1つ，その最後の軸と同じ長さの1次元のデータセット（横軸）が1つあり，
+    # map_infoの項目が属性かスカラーのデータセットにあるファイルだけ扱える．openはそれ以外ならNoneを返す
+    def __init__(self, f: h5py.File, spectra: h5py.Dataset, xdata: np.ndarray, map_info: dict):
+        self.file = f
+        self.spectra = spectra
+        self.xdata = xdata
+        self.map_info = map_info
+
+    @classmethod
+    def open(cls, p: Path) -> 'LazyHDFReader | None':
+        f = h5py.File(p, 'r')
+        spectra = find_spectra_dataset(f)
+        xdata = []
+        map_info = {key: f.attrs[key] for key in MAP_INFO_KEYS if key in f.attrs}
+
+        def visit(name, obj):
+            for key in MAP_INFO_KEYS:
+                if key in obj.attrs:
+                    map_info.setdefault(key, obj.attrs[key])
+            if not isinstance(obj, h5py.Dataset):
+                return
+            if name.split('/')[-1] in MAP_INFO_KEYS and obj.ndim == 0:
+                map_info.setdefault(name.split('/')[-1], obj[()])
+            elif spectra is not None and obj.shape == spectra.shape[3:]:
+                xdata.append(obj)
+        f.visititems(visit)
+        if spectra is None or len(xdata) != 1 or len(map_info) != len(MAP_INFO_KEYS):
+            f.close()
+            return None
+        return cls(f, spectra, xdata[0][...], {key: float(value) for key, value in map_info.items()})
+
+    def close(self):
+        # ファイルはマップが使っている間開いておく．Raman488Calibrator.closeで閉じる
+        pass
 
 
 class Raman488DataProcessor:
-    def __init__(self, map_info: MapInfo = None):
+    # 積算の平均 ('mean')，宇宙線除去に使う統計量，閾値ごとの宇宙線除去データ (('crr', 閾値)) は
+    # map_info.derivedに置く（入力はMapManager.PROCESSING_GRAPH）．
+    # 使われるまで計算せず，メモリの上限を超えたら古いものから捨てる
+    def __init__(self, map_info: MapInfo = None, threshold: float = 0.01, calibrator: CalibrationManager = None):
         self.map_info: MapInfo = map_info
         self.bg_data: np.ndarray | None = None
-
-        if map_info is not None:
-            # TODO: thresholdを指定可能に
-            # 宇宙線除去データを生成しておく
-            self.map_info.map_data_crr = remove_cosmic_ray(self.map_info.map_data_4d, 0.01).mean(axis=2).transpose(1, 0, 2)
-            self.map_info.map_data_mean = self.map_info.map_data_4d.mean(axis=2).transpose(1, 0, 2)
+        # 宇宙線除去の閾値
+        self.threshold: float = threshold
+        # 標準偏差と宇宙線除去の結果をサイドカーキャッシュに保存・読み込みするためのもの
+        self.calibrator: CalibrationManager | None = calibrator
 
     def reset(self):
-        self.__init__()
+        self.__init__(threshold=self.threshold)
+
+    def load_or_compute(self, name, compute):
+        # サイドカーキャッシュに保存してあればそこから読み，なければ計算して保存する
+        cached = self.calibrator.load_sidecar(name) if self.calibrator is not None else None
+        if cached is not None:
+            return cached['value']
+        value = compute()
+        if self.calibrator is not None:
+            self.calibrator.save_sidecar(name, {'value': value})
+        return value
+
+    def set_threshold(self, threshold: float) -> None:
+        self.threshold = threshold
+
+    def has_crr_data(self) -> bool:
+        # 現在の閾値での宇宙線除去データが計算済みかどうか
+        return ('crr', self.threshold) in self.map_info.derived
+
+    def get_mean_data(self):
+        # 積算の平均 (y, x, スペクトル)．load_rawで置いたもの
+        return self.map_info.derived.get('mean', lambda: mean_accumulations(self.map_info.map_data_4d, dtype=self.map_info.dtype).transpose(1, 0, 2))
+
+    def get_crr_data(self) -> np.ndarray:
+        # 現在の閾値での宇宙線除去データ．閾値を変えたときはマスクと置き換えだけ計算し直す
+        key = ('crr', self.threshold)
+        if key in self.map_info.derived:
+            return self.map_info.derived.get(key, lambda: None)
+        results = self.compute_crr_data(self.threshold)
+        self.store_crr_data(results)
+        return results[key]
+
+    def compute_crr_data(self, threshold: float) -> dict:
+        # 閾値thresholdでの宇宙線除去データと，途中で新しく計算したもの（標準偏差など）を返す．
+        # map_info.derivedは読むだけで変えないので別スレッドから呼んでよい．置くのはstore_crr_dataで行う
+        derived = self.map_info.derived
+        map_data_4d = self.map_info.map_data_4d
+        dtype = self.map_info.dtype
+        results = {}
+
+        def compute():
+            std = derived.peek('std')
+            if std is None:
+                std = results['std'] = self.load_or_compute('std', lambda: spectra_std(map_data_4d, dtype=dtype))
+            # 宇宙線除去に使う積算の平均 (x, y, スペクトル)．ディスク上のデータは全体が必要になったときに計算する
+            mean = derived.peek('mean')
+            if isinstance(mean, np.ndarray):
+                mean_4d = mean.transpose(1, 0, 2)
+            else:
+                mean_4d = derived.peek('mean_4d')
+                if mean_4d is None:
+                    mean_4d = results['mean_4d'] = mean_accumulations(map_data_4d, dtype=dtype)
+            return remove_cosmic_ray(map_data_4d, threshold, average=True, mean=mean_4d, std=std, dtype=dtype).transpose(1, 0, 2)
+        results[('crr', threshold)] = self.load_or_compute(('crr', threshold), compute)
+        return results
+
+    def store_crr_data(self, results: dict) -> None:
+        # compute_crr_dataの結果をmap_info.derivedに置く．宇宙線除去データを最後に置いて，上限を超えても残す
+        for key, value in results.items():
+            self.map_info.derived.put(key, value)
 
     def load_bg(self, p: Path) -> None:
-        # 背景のファイルを読み込む
+        self.set_bg(self.read_bg(p))
+
+    def read_bg(self, p: Path) -> np.ndarray:
+        # 背景のファイルを読み込む．自分の状態は変えないので別スレッドから呼んでよい
+        dtype = self.map_info.dtype if self.map_info is not None else None
         reader_bg = RamanHDFReader(p)
         bg_data = reader_bg.spectra.copy()
         reader_bg.close()
         if bg_data.shape[2] < 3:
-            self.bg_data = bg_data.mean(axis=0)[0][0]
-        else:  # 3回以上の積算があるなら宇宙線除去を行う
-            self.bg_data = remove_cosmic_ray(bg_data, 0.2).mean(axis=2)[0][0]
+            return as_float(bg_data.mean(axis=0)[0][0], dtype)
+        # 3回以上の積算があるなら宇宙線除去を行う
+        return remove_cosmic_ray(bg_data, 0.2, average=True, dtype=dtype)[0][0]
+
+    def set_bg(self, bg_data: np.ndarray) -> None:
+        self.bg_data = bg_data
 
     def set_processed_data(self, is_bg_subtracted: bool, is_cosmic_ray_removed: bool) -> None:
+        # 4通りの組み合わせはどれも計算済みのデータを使い回す．背景の引き算は読み出した部分だけその都度行い，
+        # バンド強度マップは引く前のマップから背景のバンド強度を引いて求めるので，切り替えても全体の配列は作らない
         if is_cosmic_ray_removed:
-            data = self.map_info.map_data_crr
+            data, key = self.get_crr_data(), ('crr', self.threshold)
         else:
-            data = self.map_info.map_data_mean
+            data, key = self.get_mean_data(), 'mean'
         if is_bg_subtracted:
-            data = data - self.bg_data
-        self.map_info.map_data = data
+            self.map_info.derived.set_source('bg_data', self.bg_data)
+            data = SubtractedSpectra(data, self.bg_data)
+        self.map_info.set_map_data(data, key=(key, is_bg_subtracted))
 
 
 # Calibratorは自作ライブラリ。Rayleigh, Raman用のデータとフィッティングの関数等が含まれている。
 class Raman488Calibrator(CalibrationManager):
-    def __init__(self, *args, keep_ax=False, **kwargs):
+    # これより大きいファイルはスペクトルをディスク上に置いたまま扱う [byte]
+    lazy_size = 4 * 2 ** 30
+
+    def __init__(self, *args, keep_ax=False, lazy: bool | None = None, **kwargs):
         super().__init__(*args, keep_ax=keep_ax, **kwargs)
         self.reader_raw: RamanHDFReader | None = None
         self.reader_ref: RamanHDFReader | None = None
+        # Trueならディスク上に置いたまま，Falseなら全て読み込む，Noneならファイルサイズで決める
+        self.lazy = lazy
+        self.file_raw: h5py.File | None = None
 
     def load_raw(self, p: Path) -> [bool, MapInfo]:
-        # 二次元マッピングファイルを読み込む
-        self.reader_raw = RamanHDFReader(p)
+        # 二次元マッピングファイルを読み込む．サイドカーキャッシュがあれば，積算の平均と光学像などはそこから読み，
+        # 宇宙線除去に使う4次元のスペクトルはディスク上に置いたまま使う
+        self.open_sidecar(p)
+        cached = self.load_sidecar('map')
+        if cached is not None:
+            map_info = self.open_cached(p, cached)
+            if map_info is not None:
+                return True, map_info
+        lazy = self.lazy if self.lazy is not None else p.stat().st_size > self.lazy_size
+        reader = LazyHDFReader.open(p) if lazy else None
+        if lazy and reader is None:
+            print('Warning: Spectra dataset was not found in the file. Loading all data into memory.')
+        if reader is not None:
+            # スペクトルや一部のバンドは必要なときにディスクから読み出す（ファイルはreaderが開いたまま持つ）
+            self.reader_raw = reader
+            self.file_raw = reader.file
+            map_data_4d = reader.spectra  # 宇宙線除去処理のために4次元でとっておく
+            map_data = LazyMeanCube(map_data_4d, dtype=self.dtype)
+        else:
+            # float32のモードでは，読み込んだスペクトルと積算の平均をfloat32で持つ．h5pyで直接読めるファイルは
+            # 読みながら変換する．RamanHDFReaderで読むときは，変換が終わるまで元の型の配列もメモリに置く
+            reader = LazyHDFReader.open(p) if self.dtype != np.float64 else None
+            if reader is not None:
+                map_data_4d = reader.spectra = read_as_float(reader.spectra, self.dtype)
+                reader.file.close()
+                self.reader_raw = reader
+            else:
+                self.reader_raw = RamanHDFReader(p)
+                map_data_4d = self.reader_raw.spectra = as_float(self.reader_raw.spectra, self.dtype)
+            map_data = as_float(map_data_4d.mean(axis=2), self.dtype).transpose(1, 0, 2)
         self.xdata = self.reader_raw.xdata.copy()
-        map_data_4d = self.reader_raw.spectra  # 宇宙線除去処理のために4次元でとっておく
-        map_data = map_data_4d.mean(axis=2).transpose(1, 0, 2)
         map_info = MapInfo(
             xdata=self.reader_raw.xdata,
             map_data=map_data,
@@ -65,17 +285,46 @@ class Raman488Calibrator(CalibrationManager):
             img_origin=(self.reader_raw.map_info['x_start'], self.reader_raw.map_info['y_start'] + self.reader_raw.map_info['y_span']),  # Renishaw側に合わせるため
             img_size=(self.reader_raw.map_info['x_span'], -self.reader_raw.map_info['y_span']),
             map_data_4d=map_data_4d,
+            map_data_key=('mean', False),
+            dtype=self.dtype,
         )
+        # 積算の平均は読み込んだときに1回だけ計算する（ディスク上のデータなら読み出す窓口）
+        map_info.derived.put('mean', map_data, pinned=True)
+        if isinstance(map_data, np.ndarray):  # ディスク上に置いたままのデータは保存しない
+            self.save_sidecar('map', {**map_info.to_arrays(), 'mean': map_data, 'shape_4d': np.array(map_data_4d.shape)})
         return True, map_info
 
-    def load_ref(self, p: Path) -> bool:
+    def open_cached(self, p: Path, cached: dict) -> MapInfo | None:
+        # サイドカーキャッシュから開く．4次元のスペクトルが見つからなければNone（普通に読み込む）
+        # 4次元のスペクトルは宇宙線除去にしか使わず，その結果もサイドカーキャッシュにあるので，ファイルの大きさによらずディスク上に置いたままにする
+        self.file_raw = h5py.File(p, 'r')
+        map_data_4d = find_spectra_dataset(self.file_raw, tuple(cached['shape_4d'].tolist()))
+        if map_data_4d is None:
+            self.file_raw.close()
+            self.file_raw = None
+            return None
+        self.reader_raw = SidecarReader(cached['xdata'])
+        self.xdata = cached['xdata'].copy()
+        map_info = MapInfo.from_arrays(cached, map_data=cached['mean'], map_data_4d=map_data_4d, map_data_key=('mean', False),
+                                       dtype=self.dtype)
+        map_info.derived.put('mean', map_info.map_data, pinned=True)
+        return map_info
+
+    def read_ref(self, p: Path) -> RamanHDFReader:
         # 標準サンプルのファイルを読み込む
-        self.reader_ref = RamanHDFReader(p)
-        if self.reader_ref.spectra.shape[0] > 1 or self.reader_ref.spectra.shape[1] > 1:
+        reader_ref = RamanHDFReader(p)
+        if reader_ref.spectra.shape[0] > 1 or reader_ref.spectra.shape[1] > 1:
             print('Warning: Reference file contains multiple spectra. Only the first one is used.')
-        if not self.is_xdata_correct():
-            return False
-        self.reader_ref.spectra = self.reader_ref.spectra[0][0][0]
-        self.set_data(self.reader_ref.xdata, self.reader_ref.spectra)
-        self.is_ref_loaded = True
-        return True
+        reader_ref.spectra = reader_ref.spectra[0][0][0]
+        return reader_ref
+
+    def close(self):
+        super().close()
+        if self.file_raw is not None:
+            self.file_raw.close()
+            self.file_raw = None
+
+
+instrumentation.register(Raman488Calibrator, 'load_raw', 'open_cached', 'read_ref')
+instrumentation.register(Raman488DataProcessor, 'read_bg', 'get_crr_data', 'compute_crr_data', 'set_processed_data')
+instrumentation.register(sys.modules[__name__], 'remove_cosmic_ray', 'spectra_std', 'mean_accumulations')
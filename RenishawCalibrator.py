@@ -1,9 +1,11 @@
+import sys
 from pathlib import Path
 from PIL import Image
 from renishawWiRE import WDFReader
-from CalibrationManager import CalibrationManager
+from CalibrationManager import CalibrationManager, SidecarReader
 from MapManager import MapInfo
 from utils import column_to_row
+import instrumentation
 
 
 # Calibratorは自作ライブラリ。Rayleigh, Raman用のデータとフィッティングの関数等が含まれている。
@@ -14,6 +16,18 @@ class RenishawCalibrator(CalibrationManager):
         self.reader_ref: WDFReader | None = None
 
     def load_raw(self, p: Path) -> [bool, MapInfo]:
+        # サイドカーキャッシュがあればWDFファイルを読まずにそこから開く．なければ読み込んで保存しておく
+        self.open_sidecar(p)
+        cached = self.load_sidecar('map')
+        if cached is not None:
+            self.reader_raw = SidecarReader(cached['xdata'])
+            return True, MapInfo.from_arrays(cached, map_data=cached['map_data'], dtype=self.dtype)
+        ok, map_info = self.read_raw(p)
+        if ok:
+            self.save_sidecar('map', {**map_info.to_arrays(), 'map_data': map_info.map_data})
+        return ok, map_info
+
+    def read_raw(self, p: Path) -> [bool, MapInfo]:
         # 二次元マッピングファイルを読み込む
         self.reader_raw = WDFReader(p)
         map_data = self.reader_raw.spectra
@@ -29,6 +43,7 @@ class RenishawCalibrator(CalibrationManager):
                 img=Image.new('RGB', (1, 1), (200, 200, 200)),
                 img_origin=(-0.1, -0.1),
                 img_size=(1.2, 1.2),
+                dtype=self.dtype,
             )
             return True, map_info
         # マップ測定なら(x座標) x (y座標) x (スペクトル) の3次元のはず．そうでなければエラー
@@ -46,22 +61,29 @@ class RenishawCalibrator(CalibrationManager):
             img=Image.open(self.reader_raw.img),
             img_origin=self.reader_raw.img_origins,
             img_size=self.reader_raw.img_dimensions,
+            dtype=self.dtype,
         )
         return True, map_info
 
-    def load_ref(self, p: Path) -> bool:
+    def read_ref(self, p: Path) -> WDFReader:
         # 標準サンプルのファイルを読み込む
-        self.reader_ref = WDFReader(p)
-        if len(self.reader_ref.spectra.shape) == 3:  # when choose 2D data for reference
-            self.reader_ref.spectra = self.reader_ref.spectra[0][0]  # TODO: allow user to choose
+        reader_ref = WDFReader(p)
+        if len(reader_ref.spectra.shape) == 3:  # when choose 2D data for reference
+            reader_ref.spectra = reader_ref.spectra[0][0]  # TODO: allow user to choose
             print('Warning: Reference file contains multiple spectra. Only the first one is used.')
-        if not self.is_xdata_correct():
-            if self.calc_xdata_diff() > 0.1:
+        return reader_ref
+
+    def check_ref(self, reader_ref: WDFReader) -> bool:
+        if not self.is_xdata_correct(reader_ref):
+            if self.calc_xdata_diff(reader_ref) > 0.1:
                 print('Warning: Xdata of raw and reference data are not the same.')
                 print('Please check the calibration.')
                 return False
             print('Warning: Xdata of raw and reference data are not the same.')
             print('The difference is less than 0.1 cm-1. Proceeding with calibration.')
-        self.set_data(self.reader_ref.xdata, self.reader_ref.spectra)
-        self.is_ref_loaded = True
         return True
+
+
+# WDFReaderの読み込みはread_raw, read_refの中で計測される
+instrumentation.register(RenishawCalibrator, 'load_raw', 'read_raw', 'read_ref')
+instrumentation.register(sys.modules[__name__], 'column_to_row')
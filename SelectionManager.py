@@ -0,0 +1,48 @@
+import numpy as np
+
+
+class SelectionManager:  # 保存リスト（保存する点の集合）を管理するクラス
+    def __init__(self, shape: tuple = (0, 0)):
+        # マップと同じ大きさのbool配列で持つ．追加・削除・確認は1点あたり定数時間
+        self.mask: np.ndarray = np.zeros(shape, dtype=bool)
+        # 選択されている点の数
+        self.count: int = 0
+
+    def reset(self, shape: tuple = (0, 0)) -> None:
+        self.__init__(shape)
+
+    def contains(self, row: int, col: int) -> bool:
+        return bool(self.mask[row, col])
+
+    def add(self, row: int, col: int) -> bool:
+        # 新しく追加されたときだけTrueを返す
+        if self.mask[row, col]:
+            return False
+        self.mask[row, col] = True
+        self.count += 1
+        return True
+
+    def remove(self, row: int, col: int) -> bool:
+        # 実際に削除されたときだけTrueを返す
+        if not self.mask[row, col]:
+            return False
+        self.mask[row, col] = False
+        self.count -= 1
+        return True
+
+    def add_all(self) -> None:
+        self.mask[:] = True
+        self.count = self.mask.size
+
+    def clear(self) -> None:
+        self.mask[:] = False
+        self.count = 0
+
+    def position(self, row: int, col: int) -> int:
+        # (row, col) がindices()の何番目にあるか（選択されていなければ入る位置）
+        return int(np.count_nonzero(self.mask[:, :col]) + np.count_nonzero(self.mask[:row, col]))
+
+    def indices(self) -> np.ndarray:
+        # 選択されている点の (ix, iy)，(点数, 2)．ixが小さい順，同じixの中ではiyが小さい順
+        ix, iy = np.nonzero(self.mask.T)
+        return np.stack([ix, iy], axis=1)
@@ -0,0 +1,197 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+import matplotlib
+import matplotlib.pyplot  # MapManagerの型注釈で参照される
+from CalibrationManager import CalibrationManager
+from CacheManager import set_sidecar, get_sidecar_location, get_sidecar_limit
+from export import SPECTRA_FORMATS, construct_filename, make_header, write_spectrum, write_spectra
+from utils import make_grid, resample_spectra, float_dtype, PRECISIONS
+import instrumentation
+
+
+def find_ref(raw: Path, ref: list[Path] | None, ref_pattern: str | None) -> list[Path]:
+    # マッピングファイルに対応するリファレンスファイルを決める
+    # ref_patternは '{stem}', '{suffix}' を含むファイル名で，マッピングファイルと同じフォルダから探す
+    if ref is not None:
+        return ref
+    return [raw.parent / ref_pattern.format(stem=raw.stem, suffix=raw.suffix)]
+
+
+def find_material(ref: Path, material_list: list) -> str | None:
+    # GUIと同様にリファレンスのファイル名から参照物質を推定する
+    found = None
+    for material in material_list:
+        if material in ref.name:
+            found = material
+    return found
+
+
+def calibrate_and_export(job: dict) -> tuple[Path, int, int]:
+    # 1つのマッピングファイルをキャリブレーションして，全点を書き出す
+    # プロセスプールのワーカーで実行するため，引数・戻り値はpickleできるものに限る
+    raw: Path = job['raw']
+    refs: list[Path] = job['ref']
+    set_sidecar(job['sidecar'], job['sidecar_limit'])
+    if raw.suffix == '.wdf':
+        from RenishawCalibrator import RenishawCalibrator
+        calibrator = RenishawCalibrator(dtype=job['precision'])
+        is_raman488 = False
+    elif raw.suffix == '.hdf5':
+        from Raman488Calibrator import Raman488Calibrator
+        calibrator = Raman488Calibrator(dtype=job['precision'])
+        is_raman488 = True
+    else:
+        raise ValueError('Only .wdf or .hdf5 files are acceptable.')
+
+    try:
+        ok, map_info = calibrator.load_raw(raw)
+        if not ok:
+            raise ValueError('Not a map data.')
+        if is_raman488:
+            from Raman488Calibrator import Raman488DataProcessor
+            processor = Raman488DataProcessor(map_info=map_info, threshold=job['threshold'], calibrator=calibrator)
+            if job['bg'] is not None:
+                processor.load_bg(job['bg'])
+            processor.set_processed_data(is_bg_subtracted=job['bg'] is not None, is_cosmic_ray_removed=job['remove_cosmic_ray'])
+
+        calibrator.set_dimension(job['dimension'])
+        calibrator.set_material(job['material'])
+        calibrator.set_function(job['function'])
+        if len(refs) > 1:  # ドリフト補正．行ごとの横軸から全点をxdataに揃える
+            n_rows = map_info.shape[0]
+            positions = job['ref_rows'] if job['ref_rows'] is not None else np.linspace(0, n_rows - 1, len(refs))
+            if not calibrator.calibrate_drift(refs, positions, n_rows):
+                raise ValueError('Calibration failed or X-axis data does not match the references.')
+            map_info.set_map_data(resample_spectra(calibrator.row_xdata, map_info.map_data, calibrator.xdata, extrapolate=True,
+                                                   dtype=map_info.dtype))
+        else:
+            if not calibrator.load_ref(refs[0]):
+                raise ValueError(f'X-axis data does not match the reference {refs[0].name}.')
+            calibrator.reset_data()
+            if not calibrator.calibrate():
+                raise ValueError('Calibration failed.')
+        map_info.set_xdata(calibrator.xdata)
+
+        header = make_header(raw.resolve(), ', '.join(str(ref.resolve()) for ref in refs), calibrator.calibration_info,
+                             is_raman488=is_raman488, abs_path_bg=job['bg'].resolve() if job['bg'] is not None else '',
+                             cosmic_ray_removed=job['remove_cosmic_ray'], grid=job['grid'])
+        xdata, map_data = map_info.xdata, map_info.map_data
+        if job['grid'] is not None:  # 全点をまとめて等間隔の横軸に補間する
+            xdata = make_grid(*job['grid'])
+            map_data = resample_spectra(map_info.xdata, map_info.map_data, xdata, dtype=map_info.dtype)
+        folder_to_save: Path = job['out'] if job['out'] is not None else raw.parent
+        folder_to_save.mkdir(parents=True, exist_ok=True)
+        n_saved = n_skipped = 0
+        if job['format'] != 'txt':  # 全点を1つのファイルにまとめる
+            filepath = folder_to_save / (raw.stem + '.' + job['format'])
+            if filepath.exists() and not job['overwrite']:
+                return raw, 0, 1
+            rows, cols = np.indices(map_info.shape).reshape(2, -1)
+            spectra = map_data[:, :, :].reshape(-1, map_data.shape[2])  # rows, colsと同じ順番．ディスク上のデータもここで全て読む
+            write_spectra(filepath, xdata, spectra, np.stack([cols, rows], axis=1),
+                          map_info.shape, header)
+            return raw, len(rows), 0
+        for row in range(map_info.shape[0]):
+            for col in range(map_info.shape[1]):
+                filepath = folder_to_save / construct_filename(raw.stem, col, row, map_info.shape)
+                if filepath.exists() and not job['overwrite']:
+                    n_skipped += 1
+                    continue
+                write_spectrum(filepath, xdata, map_data[row, col], header)
+                n_saved += 1
+    finally:
+        calibrator.close()
+    return raw, n_saved, n_skipped
+
+
+def run_job(job: dict) -> tuple[tuple[Path, int, int], list]:
+    # プロセスプールのワーカーはos._exitで終わり，atexitでのトレースの書き出しが走らないので，
+    # 計測した呼び出しは結果と一緒に親に返し，親がまとめて書き出す（失敗したジョブの分は残らない）
+    instrumentation.take_events()  # forkで親から引き継いだもの．親が持っている
+    return calibrate_and_export(job), instrumentation.take_events()
+
+
+def main():
+    matplotlib.use('Agg')  # GUIなしで動かす（ワーカーは図を作らない）
+    c = CalibrationManager()  # 選択肢を取得するために一時的にCalibratorを作成
+    material_list = c.get_material_list()
+    function_list = c.get_function_list()
+    dimension_list = c.get_dimension_list()
+
+    parser = argparse.ArgumentParser(description='Calibrate Raman maps and export every spectrum without the GUI.')
+    parser.add_argument('raw', type=Path, nargs='+', help='map files to calibrate (.wdf or .hdf5)')
+    group_ref = parser.add_mutually_exclusive_group(required=True)
+    group_ref.add_argument('--ref', type=Path, nargs='+',
+                           help='reference file used for all maps. Several files in measurement order enable drift correction')
+    group_ref.add_argument('--ref-pattern', help="reference file name next to each map, e.g. '{stem}_ref{suffix}'")
+    parser.add_argument('--ref-rows', type=float, nargs='+',
+                        help='map row measured at the same time as each --ref (default: first and last rows, evenly spaced)')
+    parser.add_argument('--material', choices=material_list,
+                        help='reference material (guessed from the reference file name if omitted; maps whose material cannot be guessed fail)')
+    parser.add_argument('--function', choices=function_list, default=function_list[0])
+    parser.add_argument('--dimension', type=int, default=int(dimension_list[0][0]))
+    parser.add_argument('--bg', type=Path, help='background file (488 Raman only)')
+    parser.add_argument('--remove-cosmic-ray', action='store_true', help='remove cosmic rays (488 Raman only)')
+    parser.add_argument('--threshold', type=float, default=0.01, help='threshold of cosmic ray removal')
+    parser.add_argument('--out', type=Path, help='output folder (next to each map if omitted)')
+    parser.add_argument('--format', choices=['txt'] + [ext[1:] for ext in SPECTRA_FORMATS], default='txt',
+                        help='txt: one file per spectrum, npz/h5: one file per map')
+    parser.add_argument('--grid', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'),
+                        help='resample every spectrum onto a uniform x-axis from START to STOP')
+    parser.add_argument('--precision', choices=PRECISIONS, default=float_dtype().name,
+                        help='float type of spectra and maps. float32 halves the memory')
+    parser.add_argument('--sidecar-cache', nargs='?', const='next', default=get_sidecar_location(), metavar='DIR',
+                        help='reuse maps and cosmic ray removal saved when they were opened before (next to each map without DIR)')
+    parser.add_argument('--sidecar-limit', type=float, default=get_sidecar_limit() / 2 ** 20, metavar='MiB',
+                        help='size of each sidecar cache folder')
+    parser.add_argument('--overwrite', action='store_true', help='overwrite existing files')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+    if args.ref_rows is not None and (args.ref is None or len(args.ref_rows) != len(args.ref)):
+        parser.error('--ref-rows needs one row for each --ref')
+    if args.grid is not None and (args.grid[2] <= 0 or args.grid[0] >= args.grid[1]):
+        parser.error('--grid needs START < STOP and STEP > 0')
+
+    # リファレンスが見つからない，参照物質が決まらないマップは，ワーカーに渡さずに失敗として数える
+    jobs = []
+    n_failed = 0
+    for raw in args.raw:
+        ref = find_ref(raw, args.ref, args.ref_pattern)
+        missing = [p for p in ref if not p.is_file()]
+        if missing:
+            n_failed += 1
+            print(f'Error: {raw.name}: reference file {missing[0]} was not found.')
+            continue
+        material = args.material or find_material(ref[0], material_list)
+        if material is None:
+            n_failed += 1
+            print(f'Error: {raw.name}: could not guess the reference material from {ref[0].name}. '
+                  f'Specify it with --material ({", ".join(material_list)}).')
+            continue
+        jobs.append(dict(
+            raw=raw, ref=ref, ref_rows=args.ref_rows, material=material, function=args.function, dimension=args.dimension,
+            bg=args.bg, remove_cosmic_ray=args.remove_cosmic_ray, threshold=args.threshold,
+            out=args.out, format=args.format, overwrite=args.overwrite, grid=args.grid, precision=args.precision,
+            sidecar=args.sidecar_cache, sidecar_limit=int(args.sidecar_limit * 2 ** 20),
+        ))
+
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(jobs)))) as executor:
+        futures = {executor.submit(run_job, job): job['raw'] for job in jobs}
+        for future in as_completed(futures):
+            try:
+                (raw, n_saved, n_skipped), events = future.result()
+            except Exception as e:
+                n_failed += 1
+                print(f'Error: {futures[future].name}: {e}')
+                continue
+            instrumentation.add_events(events)
+            print(f'{raw.name}: saved {n_saved} spectra' + (f', skipped {n_skipped} existing files' if n_skipped else ''))
+    if n_failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from PIL import Image
+from MapManager import MapManager, MapInfo, MAP_RANGE_LIST, band_index, calc_band_maps, parse_map_range
+from utils import column_to_row, remove_cosmic_ray, make_grid, resample_spectra, cumsum_spectra, integrate_bands, \
+    mean_accumulations, set_precision, float_dtype, as_float, PRECISIONS
+from export import construct_filename, make_header, write_spectrum, write_spectra
+
+# 合成データの大きさ
+# Renishaw: (一辺の点数, チャンネル数), Raman488: (一辺の点数, 積算回数, チャンネル数)
+SIZES = {
+    'small': {'Renishaw': (50, 1015), 'Raman488': (20, 5, 1340)},
+    'medium': {'Renishaw': (100, 1015), 'Raman488': (40, 5, 1340)},
+    'large': {'Renishaw': (200, 1015), 'Raman488': (80, 5, 1340)},
+}
+
+
+def column_to_row_loop(data: np.ndarray):
+    # 以前のcolumn_to_row（比較用）
+    data_new = np.zeros_like(data)
+    for i1 in range(data.shape[0]):
+        for j1 in range(data.shape[1]):
+            index = i1 * data.shape[1] + j1
+            i2 = index % data.shape[0]
+            j2 = index // data.shape[0]
+            data_new[i2, j2] = data[i1, j1]
+    return data_new
+
+
+def make_spectra(rng: np.random.Generator, shape: tuple, xdata: np.ndarray) -> np.ndarray:
+    # G, Dバンドのようなピークとノイズを持つスペクトル
+    peaks = 1000 * np.exp(-((xdata - 1590) / 10) ** 2) + 300 * np.exp(-((xdata - 1350) / 20) ** 2)
+    amplitude = rng.uniform(0.5, 1.5, shape[:-1] + (1,))
+    return (amplitude * peaks + rng.normal(500, 20, shape)).astype(np.float32)
+
+
+def make_renishaw(rng: np.random.Generator, side: int, channels: int) -> tuple:
+    # WiREのマッピングと同様にcolumn majorで並んだ (x, y, スペクトル)
+    xdata = np.linspace(3200, 100, channels)
+    return xdata, make_spectra(rng, (side, side, channels), xdata)
+
+
+def make_raman488(rng: np.random.Generator, side: int, accumulations: int, channels: int, offset: float = 0) -> tuple:
+    # (x, y, 積算, スペクトル) に宇宙線を混ぜる．offsetは検出器のベースライン（実際のデータでは数万カウント）
+    xdata = np.linspace(100, 3200, channels)
+    spectra = make_spectra(rng, (side, side, accumulations, channels), xdata).astype(np.float64) + offset
+    spectra[rng.random(spectra.shape) < 1e-4] += 5000
+    return xdata, spectra
+
+
+def make_map_info(xdata: np.ndarray, map_data: np.ndarray, map_data_4d: np.ndarray = None) -> MapInfo:
+    shape = map_data.shape[:2]
+    kwargs = {} if map_data_4d is None else {'map_data_4d': map_data_4d}
+    map_info = MapInfo(
+        xdata=xdata,
+        map_data=map_data,
+        shape=shape,
+        map_origin=(0, 0),
+        map_pixel=(1, 1),
+        map_size=(shape[1], shape[0]),
+        img=Image.new('RGB', (shape[1] * 4, shape[0] * 4), (200, 200, 200)),
+        img_origin=(0, 0),
+        img_size=(shape[1], shape[0]),
+        **kwargs,
+    )
+    if map_data_4d is not None:  # Raman488Calibrator.load_rawと同じ
+        map_info.derived.put('mean', map_data, pinned=True)
+    return map_info
+
+
+class Benchmark:
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.results = []
+        # float32とfloat64の結果の比較（--check-precision）
+        self.precision = []
+
+    def measure(self, stage: str, size: str, shape: tuple, func, setup=None) -> None:
+        # 時間はrepeat回の最短，メモリは1回分のピーク（tracemallocで追跡した確保量）
+        # setupの戻り値がfuncの引数になる．setupにかかる時間・メモリは含めない
+        try:
+            times = []
+            for _ in range(self.repeat):
+                args = setup() if setup is not None else ()
+                start = time.perf_counter()
+                func(*args)
+                times.append(time.perf_counter() - start)
+            args = setup() if setup is not None else ()
+            tracemalloc.start()
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        except ImportError as e:  # 計測できない環境では飛ばす
+            print(f'{stage:<32} {size:<8} skipped ({e})')
+            self.results.append({'stage': stage, 'size': size, 'shape': list(shape), 'skipped': str(e)})
+            return
+        print(f'{stage:<32} {size:<8} {min(times):>10.4f} s {peak / 2 ** 20:>10.1f} MiB')
+        self.results.append({'stage': stage, 'size': size, 'shape': list(shape),
+                             'time': min(times), 'times': times, 'peak_memory': peak})
+
+    def save(self, filepath: Path) -> None:
+        data = {
+            'environment': {
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'matplotlib': matplotlib.__version__,
+                'platform': platform.platform(),
+            },
+            'precision': float_dtype().name,
+            'results': self.results,
+            'precision_check': self.precision,
+        }
+        with filepath.open('w') as f:
+            json.dump(data, f, indent=2)
+
+
+def bench_renishaw(bench: Benchmark, rng: np.random.Generator, size: str, with_loop: bool) -> None:
+    side, channels = SIZES[size]['Renishaw']
+    xdata, spectra = make_renishaw(rng, side, channels)
+    shape = spectra.shape
+
+    if with_loop:
+        bench.measure('column_to_row_loop', size, shape, lambda: column_to_row_loop(spectra))
+    bench.measure('column_to_row', size, shape, lambda: column_to_row(spectra))
+
+    map_data = column_to_row(spectra)
+
+    def setup_map_manager():
+        # 読み込み直後のMapManager
+        fig, ax = plt.subplots()
+        map_manager = MapManager()
+        map_manager.set_ax(ax)
+        map_manager.load(make_map_info(xdata, map_data))
+        map_manager.map_range = (1570, 1610)
+        return map_manager, fig
+
+    def first_map(map_manager, fig):
+        map_manager.clear_and_show()
+        plt.close(fig)
+
+    def update_map(map_manager, fig):
+        for map_range in map_manager.map_range_list:
+            map_manager.update_map(map_range=tuple(map(int, map_range.split('~'))))
+        plt.close(fig)
+
+    def setup_loaded_map():
+        map_manager, fig = setup_map_manager()
+        map_manager.clear_and_show()
+        return map_manager, fig
+
+    bench.measure('MapManager._calc_map_data', size, shape, lambda m, f: m._calc_map_data(), setup_map_manager)
+    bench.measure('MapManager.clear_and_show', size, shape, first_map, setup_map_manager)
+    bench.measure('MapManager.update_map(presets)', size, shape, update_map, setup_loaded_map)
+    bench.measure('resample_spectra', size, shape, lambda: resample_spectra(xdata, map_data, make_grid(100, 3200, 1)))
+
+    bench_export(bench, size, xdata, map_data)
+
+
+def bench_raman488(bench: Benchmark, rng: np.random.Generator, size: str) -> None:
+    side, accumulations, channels = SIZES[size]['Raman488']
+    xdata, spectra = make_raman488(rng, side, accumulations, channels)
+    shape = spectra.shape
+
+    bench.measure('remove_cosmic_ray', size, shape, lambda: remove_cosmic_ray(spectra, 0.01))
+    bench.measure('remove_cosmic_ray(average)', size, shape, lambda: remove_cosmic_ray(spectra, 0.01, average=True))
+
+    def construct_processor():
+        from Raman488Calibrator import Raman488DataProcessor
+        map_data = spectra.mean(axis=2).transpose(1, 0, 2)  # Raman488Calibrator.load_rawと同じ
+        return Raman488DataProcessor(map_info=make_map_info(xdata, map_data, spectra))
+
+    def setup_processor():
+        return construct_processor(),
+
+    def process(processor):
+        processor.bg_data = spectra[0, 0, 0]
+        processor.set_processed_data(is_bg_subtracted=True, is_cosmic_ray_removed=True)
+
+    bench.measure('Raman488DataProcessor()', size, shape, construct_processor)
+    bench.measure('Raman488DataProcessor.process', size, shape, process, setup_processor)
+
+
+def bench_export(bench: Benchmark, size: str, xdata: np.ndarray, map_data: np.ndarray) -> None:
+    # MainWindow.saveと同じ書き出し（全点を選択したとき）
+    header = make_header('raw.wdf', 'ref.wdf', 'calibration_info')
+    rows, cols = np.indices(map_data.shape[:2]).reshape(2, -1)
+    shape = map_data.shape
+
+    def save_txt():
+        with tempfile.TemporaryDirectory() as folder:
+            for row, col in zip(rows, cols):
+                filepath = Path(folder) / construct_filename('raw', col, row, map_data.shape[:2])
+                write_spectrum(filepath, xdata, map_data[row, col], header)
+
+    def save_spectra(ext):
+        with tempfile.TemporaryDirectory() as folder:
+            write_spectra(Path(folder) / f'raw{ext}', xdata, map_data[rows, cols], np.stack([cols, rows], axis=1),
+                          map_data.shape[:2], header)
+
+    bench.measure('export(txt)', size, shape, save_txt)
+    bench.measure('export(npz)', size, shape, lambda: save_spectra('.npz'))
+    bench.measure('export(h5)', size, shape, lambda: save_spectra('.h5'))
+
+
+def bench_calibration(bench: Benchmark) -> None:
+    # 硫黄などの標準サンプルのピークを少しずらした合成スペクトルでキャリブレーションする
+    def setup():
+        from CalibrationManager import CalibrationManager
+        calibrator = CalibrationManager()
+        calibrator.set_material(calibrator.get_material_list()[0])
+        calibrator.set_dimension(int(calibrator.get_dimension_list()[0][0]))
+        calibrator.set_function(calibrator.get_function_list()[0])
+        xdata = np.linspace(50, 3200, 1015)
+        ydata = np.full_like(xdata, 100.0)
+        for x in calibrator.get_true_x():
+            ydata += 1000 / (1 + ((xdata - x - 3) / 5) ** 2)
+        calibrator.set_data(xdata, ydata)
+        return calibrator,
+
+    # 毎回フィットを計測する（キャッシュも使わない）
+    bench.measure('CalibrationManager.calibrate', '-', (1015,), lambda c: c.calibrate(use_cache=False), setup)
+
+
+# --check-precisionで試すベースライン．合成データのままのもの（500カウント）と，実際の488Ramanのデータ程度のもの
+PRECISION_OFFSETS = (0, 30000)
+
+
+def check_precision(rng: np.random.Generator, size: str, offset: float) -> list:
+    # float32のモードの結果をfloat64の結果と比べる（488Ramanの読み込みからバンド強度マップ，書き出しの補間まで）
+    # 誤差はfloat64の結果の絶対値の最大で割った相対誤差．宇宙線の判定は閾値ちょうど付近の点で入れ替わることがある
+    # バンド強度マップは宇宙線の判定の入れ替わりを含まないよう，積算の平均（開いたときに表示するもの）で比べる
+    # 背景を引く前（ベースラインが高い）と引いた後の両方
+    side, accumulations, channels = SIZES[size]['Raman488']
+    xdata, spectra = make_raman488(rng, side, accumulations, channels, offset)
+    bg_data = spectra[0, 0].mean(axis=0)
+    map_ranges = [parse_map_range(map_range) for map_range in MAP_RANGE_LIST]
+
+    def pipeline():
+        data = as_float(spectra)
+        crr = remove_cosmic_ray(data, 0.01, average=True).transpose(1, 0, 2)  # Raman488DataProcessorと同じ
+        subtracted = crr - as_float(bg_data)
+        mean = mean_accumulations(data).transpose(1, 0, 2)
+        stages = {'mean': mean, 'remove_cosmic_ray': crr, 'subtract_bg': subtracted}
+        for name, map_data in (('', mean), ('(bg) ', mean - as_float(bg_data))):
+            # 累積和はfloat64で持つ（float32のモードでもMapInfo.get_cumsumを使わずに渡したときの結果）
+            band_maps = calc_band_maps(xdata, map_data, map_ranges, cumsum=cumsum_spectra(map_data))
+            stages.update({f'band_map(cumsum) {name}{r[0]:g}~{r[1]:g}': m for r, m in band_maps.items()})
+            band_maps = integrate_bands(map_data, [band_index(xdata, r) for r in map_ranges])
+            stages.update({f'band_map {name}{r[0]:g}~{r[1]:g}': m for r, m in zip(map_ranges, band_maps)})
+        stages['resample_spectra'] = resample_spectra(xdata, subtracted, make_grid(100, 3200, 1))
+        return stages
+
+    precision = float_dtype().name
+    try:
+        set_precision('float64')
+        expected = pipeline()
+        set_precision('float32')
+        actual = pipeline()
+    finally:
+        set_precision(precision)
+    results = []
+    print(f'{"stage":<32} {"size":<8} {"offset":>8} {"dtype":>8} {"max error":>10} {"> 1e-4":>10}')
+    for stage, value in expected.items():
+        error = np.abs(actual[stage] - value) / np.abs(value).max()
+        over = np.count_nonzero(error > 1e-4) / error.size
+        print(f'{stage:<32} {size:<8} {offset:>8g} {actual[stage].dtype.name:>8} {error.max():>10.2e} {over:>10.2e}')
+        results.append({'stage': stage, 'size': size, 'offset': offset, 'dtype': actual[stage].dtype.name,
+                        'max_error': float(error.max()), 'fraction_over_1e-4': over})
+    return results
+
+
+def bench_startup(bench: Benchmark) -> None:
+    # GUIの起動前にかかるimportの時間（新しいプロセスで測る）．最初の描画までは python main.py --startup-time で測る
+    def import_main():
+        result = subprocess.run([sys.executable, '-c', 'import main'], cwd=Path(__file__).parent, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise ImportError(result.stderr.strip().splitlines()[-1])
+
+    bench.measure('import main', '-', (), import_main)
+
+
+def main():
+    matplotlib.use('Agg')  # GUIなしで動かす
+    parser = argparse.ArgumentParser(description='Benchmark of RamanCalibrator hot paths with synthetic data.')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--with-loop', action='store_true', help='also measure the old per-pixel column_to_row')
+    parser.add_argument('--precision', choices=PRECISIONS, default=float_dtype().name, help='float type of spectra and maps')
+    parser.add_argument('--check-precision', action='store_true', help='also compare the float32 results with float64')
+    parser.add_argument('--output', type=Path, default=Path('benchmark.json'), help='JSON file to write the results')
+    args = parser.parse_args()
+    set_precision(args.precision)
+
+    bench = Benchmark(args.repeat)
+    rng = np.random.default_rng(0)
+    print(f'{"stage":<32} {"size":<8} {"time":>12} {"peak memory":>14}')
+    for size in args.sizes:
+        bench_renishaw(bench, rng, size, args.with_loop)
+        bench_raman488(bench, rng, size)
+    bench_calibration(bench)
+    bench_startup(bench)
+    if args.check_precision:
+        bench.precision = [result for size in args.sizes for offset in PRECISION_OFFSETS
+                           for result in check_precision(rng, size, offset)]
+    bench.save(args.output)
+    print(f'Results were saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
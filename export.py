@@ -0,0 +1,102 @@
+from pathlib import Path
+import numpy as np
+
+# 1ファイルにまとめて保存するときの形式．488Ramanの生データ(.hdf5)と区別するためHDF5は.h5にする
+SPECTRA_FORMATS = ('.npz', '.h5')
+
+
+def construct_filename(stem: str, ix: int, iy: int, shape: tuple) -> str:
+    # ファイル名はスペクトルのインデックスになる
+    ny, nx = shape
+    # 0埋め
+    ix = str(ix).zfill(len(str(nx)))
+    iy = str(iy).zfill(len(str(ny)))
+    return f'{stem}_{ix}_{iy}.txt'
+
+
+def make_header(abs_path_raw, abs_path_ref, calibration_info, is_raman488: bool = False, abs_path_bg='', cosmic_ray_removed: bool = False,
+                grid: tuple = None) -> dict:
+    # 保存するファイルの先頭に書く情報
+    # grid: 等間隔の横軸に補間して保存する場合の (start, stop, step)
+    header = {
+        'abs_path_raw': abs_path_raw,
+        'abs_path_ref': abs_path_ref,
+    }
+    if is_raman488:
+        header['abs_path_bg'] = abs_path_bg
+        header['cosmic_ray_removed'] = 'Yes' if cosmic_ray_removed else 'No'
+    header['calibration'] = calibration_info
+    if grid is not None:
+        header['grid'] = '{}~{}, step {}'.format(*grid)
+    return header
+
+
+def write_spectrum(filepath: Path, xdata: np.ndarray, spectrum: np.ndarray, header: dict) -> None:
+    with filepath.open('w') as f:
+        for key, value in header.items():
+            f.write(f'# {key}: {value}\n')
+        f.write('\n')
+
+        for x, y in zip(xdata, spectrum):
+            f.write(f'{x},{y}\n')
+
+
+def write_spectra(filepath: Path, xdata: np.ndarray, spectra: np.ndarray, indices: np.ndarray, shape: tuple, header: dict) -> None:
+    # 選択した点のスペクトルを1つのファイルにまとめて保存する．形式は拡張子で決める
+    # spectra: (点数, スペクトル), indices: (点数, 2) で各点の (ix, iy)
+    if filepath.suffix == '.npz':
+        write_spectra_npz(filepath, xdata, spectra, indices, shape, header)
+    elif filepath.suffix == '.h5':
+        write_spectra_hdf5(filepath, xdata, spectra, indices, shape, header)
+    else:
+        raise ValueError(f'Unknown format: {filepath.suffix}')
+
+
+def write_spectra_npz(filepath: Path, xdata: np.ndarray, spectra: np.ndarray, indices: np.ndarray, shape: tuple, header: dict) -> None:
+    header = {key: np.array(str(value)) for key, value in header.items()}
+    np.savez_compressed(filepath, xdata=xdata, spectra=spectra, indices=indices, shape=np.array(shape), **header)
+
+
+def import_h5py():
+    # HDF5で保存・読み込みするときだけ必要．起動を遅くしないよう使うときにimportする
+    try:
+        import h5py
+    except ImportError:
+        return None
+    return h5py
+
+
+def write_spectra_hdf5(filepath: Path, xdata: np.ndarray, spectra: np.ndarray, indices: np.ndarray, shape: tuple, header: dict) -> None:
+    h5py = import_h5py()
+    if h5py is None:
+        raise ImportError('h5py is required to save as .h5.')
+    with h5py.File(filepath, 'w') as f:
+        f.create_dataset('xdata', data=xdata)
+        # 一部の点だけ読み出しても全体を展開せずに済むよう，1MB程度ずつスペクトル単位でチャンクを切る
+        chunks = None
+        if spectra.size > 0:
+            chunks = (max(1, min(len(spectra), 2 ** 20 // spectra[0].nbytes)), spectra.shape[1])
+        f.create_dataset('spectra', data=spectra, chunks=chunks, compression='gzip', shuffle=True)
+        f.create_dataset('indices', data=indices)
+        f.create_dataset('shape', data=np.array(shape))
+        for key, value in header.items():
+            f.attrs[key] = str(value)
+
+
+def load_spectra(filepath: Path) -> dict:
+    # write_spectraで保存したファイルを読み込む
+    # xdata, spectra, indices, shapeと，テキスト保存時のヘッダと同じ項目を持つ辞書を返す
+    filepath = Path(filepath)
+    if filepath.suffix == '.npz':
+        with np.load(filepath) as f:
+            return {key: f[key].item() if f[key].ndim == 0 else f[key] for key in f.files}
+    elif filepath.suffix == '.h5':
+        h5py = import_h5py()
+        if h5py is None:
+            raise ImportError('h5py is required to load .h5.')
+        with h5py.File(filepath, 'r') as f:
+            data = {key: f[key][()] for key in f.keys()}
+            data.update(f.attrs)
+        return data
+    else:
+        raise ValueError(f'Unknown format: {filepath.suffix}')
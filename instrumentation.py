@@ -0,0 +1,123 @@
+import atexit
+import functools
+from collections import deque
+import json
+import os
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+# 環境変数にトレースファイルのパスを入れると計測する（'1'なら既定のファイル名）．{pid}はプロセスIDに置き換わる
+TRACE_ENV = 'RAMAN_CALIBRATOR_TRACE'
+DEFAULT_TRACE_PATH = 'trace_{pid}.json'
+
+# 計測する関数の登録 (持ち主のクラスかモジュール, 名前)．無効のときは登録するだけで包まない
+_targets: list = []
+# トレースに残す呼び出しの数の上限．超えたら古いものから捨てる（集計も残っているものだけで行う）
+MAX_EVENTS = 200_000
+_events: deque = deque(maxlen=MAX_EVENTS)
+_origin = time.perf_counter()
+_trace_path: Path | None = None
+
+
+def is_enabled() -> bool:
+    return _trace_path is not None
+
+
+def _array_size(value) -> list:
+    # 引数・戻り値に含まれる配列の形（タプルとリストは1段だけ中を見る）
+    if isinstance(value, (tuple, list)):
+        return [size for v in value[:8] if not isinstance(v, (tuple, list)) for size in _array_size(v)]
+    if getattr(value, 'shape', None) and hasattr(value, 'dtype'):  # ディスク上の配列も含む．スカラーは除く
+        return [[list(value.shape), str(value.dtype)]]
+    return []
+
+
+def _wrap(func, name: str):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        end = time.perf_counter()
+        _events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': (start - _origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {'in': [s for a in args + tuple(kwargs.values()) for s in _array_size(a)], 'out': _array_size(result)},
+        })
+        return result
+    wrapper.__wrapped_by_trace__ = True
+    return wrapper
+
+
+def _patch(owner, name: str) -> None:
+    func = owner.__dict__.get(name) if isinstance(owner, type) else getattr(owner, name, None)
+    if func is None or getattr(func, '__wrapped_by_trace__', False):
+        return
+    label = f'{owner.__name__}.{name}' if isinstance(owner, type) else name
+    setattr(owner, name, _wrap(func, label))
+
+
+def register(owner, *names: str) -> None:
+    # ownerのnamesを計測の対象にする．モジュール内でimportした関数はそのモジュールを渡す
+    for name in names:
+        _targets.append((owner, name))
+        if is_enabled():
+            _patch(owner, name)
+
+
+def enable(trace_path: str = DEFAULT_TRACE_PATH) -> None:
+    # 登録済みの関数を包み，終了時にトレースを書き出して集計を表示する
+    global _trace_path
+    if is_enabled():
+        return
+    _trace_path = Path(trace_path.format(pid=os.getpid()))
+    for owner, name in _targets:
+        _patch(owner, name)
+    atexit.register(report)
+
+
+def take_events() -> list:
+    # 記録した呼び出しを取り出して消す．プロセスプールのワーカーから親に渡すときに使う
+    events = list(_events)
+    _events.clear()
+    return events
+
+
+def add_events(events: list) -> None:
+    # 他のプロセスで記録した呼び出しを加える（pidはそのプロセスのもの）
+    _events.extend(events)
+
+
+def summary() -> list:
+    # 名前ごとの (名前, 回数, 合計[s], 平均[s], 最大[s], 最大の配列の形)
+    stats = {}
+    for event in list(_events):
+        calls, total, longest, shape = stats.get(event['name'], (0, 0.0, 0.0, None))
+        for size, _ in event['args']['in'] + event['args']['out']:
+            if shape is None or np.prod(size) > np.prod(shape):
+                shape = size
+        stats[event['name']] = (calls + 1, total + event['dur'] / 1e6, max(longest, event['dur'] / 1e6), shape)
+    rows = [(name, calls, total, total / calls, longest, shape) for name, (calls, total, longest, shape) in stats.items()]
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+def report() -> None:
+    try:
+        with _trace_path.open('w') as f:
+            json.dump({'traceEvents': list(_events), 'displayTimeUnit': 'ms'}, f)
+    except OSError as e:
+        print(f'Trace could not be written: {e}')
+    else:
+        print(f'Trace was saved to {_trace_path} (open it with chrome://tracing or https://ui.perfetto.dev)')
+    print(f'{"stage":<40} {"calls":>6} {"total":>10} {"mean":>10} {"max":>10}  largest array')
+    for name, calls, total, mean, longest, shape in summary():
+        print(f'{name:<40} {calls:>6} {total:>9.3f}s {mean:>9.4f}s {longest:>9.4f}s  {shape if shape is not None else "-"}')
+
+
+if os.environ.get(TRACE_ENV):
+    enable(DEFAULT_TRACE_PATH if os.environ[TRACE_ENV] == '1' else os.environ[TRACE_ENV])
@@ -1,4 +1,10 @@
+from startup import START_TIME  # 起動時間の計測用．他のimportより前に置く
+import time
+import argparse
 import os
+import queue
+import threading
+from typing import Callable, TYPE_CHECKING
 from pathlib import Path
 import tkinter as tk
 from tkinter import messagebox, filedialog, ttk
@@ -10,11 +16,17 @@ from matplotlib import rcParams, patches
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib.backend_bases import key_press_handler
 from CalibrationManager import CalibrationManager
-from RenishawCalibrator import RenishawCalibrator
-from Raman488Calibrator import Raman488Calibrator, Raman488DataProcessor
-from MapManager import MapManager
+from CacheManager import set_sidecar, get_sidecar_location, get_sidecar_limit
+from MapManager import MapManager, MapInfo, parse_map_range
+from SelectionManager import SelectionManager
 from MyTooltip import MyTooltip
-from utils import is_num
+from DerivedDataManager import set_memory_limit, get_memory_limit
+from utils import is_num, natural_key, make_grid, resample_spectra, set_precision, float_dtype, PRECISIONS
+from export import SPECTRA_FORMATS, construct_filename, make_header, write_spectrum, write_spectra
+import instrumentation
+if TYPE_CHECKING:  # 488Ramanの読み込み（h5pyなど）は開くときまでimportしない（import_backend）
+    from Raman488Calibrator import Raman488DataProcessor
+IMPORT_TIME = time.perf_counter()
 
 font_lg = ('Arial', 24)
 font_md = ('Arial', 16)
@@ -30,13 +42,28 @@ plt.rcParams['figure.subplot.bottom'] = 0.05
 plt.rcParams['figure.subplot.left'] = 0.05
 plt.rcParams['figure.subplot.right'] = 0.95
 
+# 保存リストの表示に一度に並べる点数．これより多いときはページに分けて表示する
+TREEVIEW_PAGE = 1000
+# 宇宙線除去の閾値の初期値
+COSMIC_RAY_THRESHOLD = 0.01
+
+
+def import_backend(mode: str) -> tuple:
+    # 装置ごとの読み込み・キャリブレーションのモジュール（renishawWiRE, dataloader）は起動を遅くするので，
+    # そのファイルが初めてドロップされたときにimportする．(Calibrator, DataProcessor) を返す
+    if mode == 'Renishaw':
+        from RenishawCalibrator import RenishawCalibrator
+        return RenishawCalibrator, None
+    from Raman488Calibrator import Raman488Calibrator, Raman488DataProcessor
+    return Raman488Calibrator, Raman488DataProcessor
+
 
 def parse_dnd_files(event) -> [Path]:
     if event.data[0] == '{':  # {}で区切られていることがある
         filenames = event.data.split('} {')
         filenames = list(map(lambda x: x.strip('{}'), filenames))
     else:
-        filenames = event.data.split()[0]
+        filenames = event.data.split()
     return list(map(Path, filenames))
 
 
@@ -64,6 +91,58 @@ def check_ref_loaded(func):
     return wrapper
 
 
+class Cancelled(Exception):
+    pass
+
+
+class BackgroundTask(threading.Thread):
+    # MainWindowの重い処理（ファイルの読み込みなど）を実行するスレッド
+    # Tkはメインスレッドからしか触れないので，結果や進捗はmessagesを通して渡す
+    # workは自分で作ったものだけを変え，画面や動いているオブジェクトへの反映はon_doneで行う
+    # kindは処理の種類（'raw', 'ref', 'bg', 'process'）．置き換えてよいのは同じ種類の処理だけ
+    # on_cancelはユーザーがキャンセルしたとき（新しい処理に置き換えられたときは呼ばない）
+    # cleanupは結果が使われなかったとき（キャンセル，置き換え，エラー），スレッドが止まってから呼ぶ
+    def __init__(self, kind: str, work, on_done, on_cancel=None, cleanup=None) -> None:
+        super().__init__(daemon=True)
+        self.kind = kind
+        self.work = work
+        self.on_done = on_done
+        self.on_cancel = on_cancel
+        self.cleanup = cleanup
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def progress(self, text: str) -> None:
+        # 処理の区切りごとに呼ばれる．キャンセルされていればここで止める
+        if self.cancelled.is_set():
+            raise Cancelled
+        self.messages.put(('progress', text))
+
+    def run(self) -> None:
+        try:
+            result = self.work(self.progress)
+        except Cancelled:
+            return
+        except Exception as e:
+            self.messages.put(('error', e))
+            return
+        self.messages.put(('done', result))
+
+
+class Toolbar(NavigationToolbar2Tk):
+    def save_figure(self, *args):
+        # animatedな部分（クロスヘア，スペクトル）は通常の描画に含まれないので，保存するときだけ戻す
+        artists = self.canvas.figure.findobj(lambda artist: artist.get_animated())
+        for artist in artists:
+            artist.set_animated(False)
+        try:
+            return super().save_figure(*args)
+        finally:
+            for artist in artists:
+                artist.set_animated(True)
+            self.canvas.draw_idle()
+
+
 class PeakSelector:
     def __init__(self, master) -> None:
         self.master = master
@@ -262,23 +341,33 @@ class MainWindow(tk.Frame):
 
         self.calibrator: CalibrationManager = CalibrationManager()
         self.map_manager: MapManager = MapManager()
-        self.processor: Raman488DataProcessor = Raman488DataProcessor()
-
-        self.row = self.col = 0
+        # 488Ramanのデータを読み込むまではNone
+        self.processor: 'Raman488DataProcessor | None' = None
+        self.selection: SelectionManager = SelectionManager()
 
         self.ax_map: plt.Axes
         self.ax_raw: plt.Axes
         self.ax_ref: plt.Axes
 
         self.line = None
-        self.selection_patches = []
+        # クロスヘアとスペクトルを除いた描画（blit用）
+        self.background = None
+        # キーを押し続けたときに描画をまとめるためのフラグ
+        self.is_plot_pending = False
 
         self.folder_raw = Path('./')
         self.folder_ref = Path('./')
         self.folder_bg = Path('./')
+        # 複数のリファレンスを読み込んだとき（ドリフト補正）はその全て．測定順に並べる
+        self.ref_paths: list[Path] = []
 
         self.mode = 'Renishaw'  # or 'Raman488'
 
+        # 別スレッドで実行中の読み込み処理
+        self.task: BackgroundTask | None = None
+        # 別の種類の処理が動いている間に頼まれた処理．種類ごとに最後のものだけを，終わってから順にやり直す
+        self.pending_tasks: dict[str, Callable[[], None]] = {}
+
         self.create_widgets()
         self.map_manager.set_ax(self.ax_map)
 
@@ -307,9 +396,12 @@ class MainWindow(tk.Frame):
         self.ax_map.set_title('Raman Map', fontsize=30)
         self.ax_raw.set_title('Spectrum', fontsize=30)
         self.ax_ref.set_title('Reference Spectrum', fontsize=30)
+        # スペクトルは点を選ぶたびに変わるので，背景とは別に描画する
+        self.ax_raw.set_animated(True)
         self.canvas = FigureCanvasTkAgg(fig, self.master)
         self.canvas.get_tk_widget().grid(row=0, column=0, rowspan=10)
-        self.toolbar = NavigationToolbar2Tk(self.canvas, self.master, pack_toolbar=False)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.toolbar = Toolbar(self.canvas, self.master, pack_toolbar=False)
         self.toolbar.update()
         self.toolbar.grid(row=10, column=0)
         # ピークの矩形選択のため
@@ -350,10 +442,21 @@ class MainWindow(tk.Frame):
         self.checkbox_subtract_bg = ttk.Checkbutton(frame_data, text='Subtract BG', variable=self.subtract_bg, command=self.process, takefocus=False)
         self.remove_cosmic_ray = tk.BooleanVar(value=False)
         self.checkbox_remove_cosmic_ray = ttk.Checkbutton(frame_data, text='Remove Cosmic Ray', variable=self.remove_cosmic_ray, command=self.process, takefocus=False)
+        vcrt = (self.register(self.validate_cosmic_ray_threshold), '%P')
+        self.label_cosmic_ray_threshold = ttk.Label(frame_data, text='Threshold:')
+        self.cosmic_ray_threshold = tk.DoubleVar(value=COSMIC_RAY_THRESHOLD)
+        self.entry_cosmic_ray_threshold = ttk.Entry(frame_data, textvariable=self.cosmic_ray_threshold, validate='key', validatecommand=vcrt, justify=tk.CENTER, font=font_md, width=6)
+        # 入力途中の値で毎回計算し直さないよう，確定したとき（Enter，フォーカスが外れたとき）だけ反映する
+        self.entry_cosmic_ray_threshold.bind('<Return>', self.apply_cosmic_ray_threshold)
+        self.entry_cosmic_ray_threshold.bind('<FocusOut>', self.apply_cosmic_ray_threshold)
+        self.memory_usage = tk.StringVar(value='Memory: 0 MiB')
+        label_memory_usage = ttk.Label(frame_data, textvariable=self.memory_usage)
+        self.tooltip_memory = MyTooltip(label_memory_usage, 'not loaded')
         label_raw.grid(row=0, column=0)
         label_ref.grid(row=1, column=0)
         label_filename_raw.grid(row=0, column=1)
         label_filename_ref.grid(row=1, column=1)
+        label_memory_usage.grid(row=6, column=0, columnspan=2)
 
         # frame_calibration
         c = CalibrationManager()  # リファレンスデータの選択肢を取得するために一時的にCalibratorを作成
@@ -393,6 +496,23 @@ class MainWindow(tk.Frame):
         self.button_save = ttk.Button(frame_download, text='SAVE', command=self.save, takefocus=False)
         self.show_selection_in_map = tk.BooleanVar(value=True)
         checkbox_show_selection_in_map = ttk.Checkbutton(frame_download, text='Show in Map', variable=self.show_selection_in_map, command=self.update_selection)
+        label_save_format = ttk.Label(frame_download, text='Format')
+        self.save_format = tk.StringVar(value='txt')  # txtは1点1ファイル，それ以外は1ファイルにまとめる
+        optionmenu_save_format = ttk.OptionMenu(frame_download, self.save_format, self.save_format.get(), 'txt', *[ext[1:] for ext in SPECTRA_FORMATS])
+        optionmenu_save_format['menu'].config(font=font_md)
+        self.selection_count = tk.StringVar(value='0 points')
+        label_selection_count = ttk.Label(frame_download, textvariable=self.selection_count)
+        self.treeview_page = 0  # 表示しているページ
+        self.button_prev_page = ttk.Button(frame_download, text='<', width=2, command=lambda: self.move_treeview_page(-1), state=tk.DISABLED, takefocus=False)
+        self.button_next_page = ttk.Button(frame_download, text='>', width=2, command=lambda: self.move_treeview_page(1), state=tk.DISABLED, takefocus=False)
+        self.resample = tk.BooleanVar(value=False)  # 等間隔の横軸に補間して保存する
+        checkbox_resample = ttk.Checkbutton(frame_download, text='Resample', variable=self.resample, takefocus=False)
+        self.grid_start = tk.DoubleVar(value=100)
+        self.grid_stop = tk.DoubleVar(value=3200)
+        self.grid_step = tk.DoubleVar(value=1)
+        entry_grid_start = ttk.Entry(frame_download, textvariable=self.grid_start, justify=tk.CENTER, font=font_md, width=6)
+        entry_grid_stop = ttk.Entry(frame_download, textvariable=self.grid_stop, justify=tk.CENTER, font=font_md, width=6)
+        entry_grid_step = ttk.Entry(frame_download, textvariable=self.grid_step, justify=tk.CENTER, font=font_md, width=6)
         self.treeview.grid(row=0, column=0, columnspan=3)
         self.button_add.grid(row=1, column=0)
         self.button_delete.grid(row=2, column=0)
@@ -400,6 +520,15 @@ class MainWindow(tk.Frame):
         self.button_delete_all.grid(row=2, column=1)
         self.button_save.grid(row=1, column=2, rowspan=2, sticky=tk.NS)
         checkbox_show_selection_in_map.grid(row=3, column=0, columnspan=3)
+        label_save_format.grid(row=4, column=0)
+        optionmenu_save_format.grid(row=4, column=1, columnspan=2, sticky=tk.EW)
+        self.button_prev_page.grid(row=5, column=0)
+        label_selection_count.grid(row=5, column=1)
+        self.button_next_page.grid(row=5, column=2)
+        checkbox_resample.grid(row=6, column=0, columnspan=3)
+        entry_grid_start.grid(row=7, column=0)
+        entry_grid_stop.grid(row=7, column=1)
+        entry_grid_step.grid(row=7, column=2)
 
         # frame_map
         vmr1 = (self.register(self.validate_map_range_1), '%P')
@@ -413,6 +542,7 @@ class MainWindow(tk.Frame):
                                                    command=self.select_map_range_preset)
         self.optionmenu_map_range.config(state=tk.DISABLED)
         self.optionmenu_map_range['menu'].config(font=font_md)
+        button_pin_map_range = ttk.Button(frame_map, text='PIN', command=self.pin_map_range, takefocus=False, width=4)
         self.map_range_1 = tk.DoubleVar(value=1570)
         self.map_range_2 = tk.DoubleVar(value=1610)
         self.entry_map_range_1 = ttk.Entry(frame_map, textvariable=self.map_range_1, validate="key", validatecommand=vmr1, justify=tk.CENTER, font=font_md, width=6)
@@ -446,6 +576,7 @@ class MainWindow(tk.Frame):
         self.optionmenu_map_range.grid(row=0, column=1, columnspan=2, sticky=tk.EW)
         self.entry_map_range_1.grid(row=1, column=1)
         self.entry_map_range_2.grid(row=1, column=2)
+        button_pin_map_range.grid(row=1, column=3)
         label_cmap_range.grid(row=2, column=0)
         self.entry_cmap_range_1.grid(row=2, column=1)
         self.entry_cmap_range_2.grid(row=2, column=2)
@@ -456,6 +587,18 @@ class MainWindow(tk.Frame):
         checkbox_map_autoscale.grid(row=5, column=0, columnspan=4)
         checkbox_show_crosshair.grid(row=6, column=0, columnspan=4)
 
+        # frame_progress（読み込み中だけ表示する）
+        self.frame_progress = ttk.Frame(self.master)
+        self.frame_progress.grid(row=5, column=1)
+        self.progress_text = tk.StringVar(value='')
+        label_progress = ttk.Label(self.frame_progress, textvariable=self.progress_text)
+        self.progressbar = ttk.Progressbar(self.frame_progress, mode='indeterminate', length=200)
+        button_cancel = ttk.Button(self.frame_progress, text='CANCEL', command=self.cancel_task, takefocus=False)
+        label_progress.grid(row=0, column=0, columnspan=2)
+        self.progressbar.grid(row=1, column=0)
+        button_cancel.grid(row=1, column=1)
+        self.frame_progress.grid_remove()
+
         # frame_plot
         self.spec_autoscale = tk.BooleanVar(value=True)
         checkbox_spec_autoscale = ttk.Checkbutton(frame_plot, text='Spectrum Auto Scale', variable=self.spec_autoscale, takefocus=False)
@@ -549,6 +692,29 @@ class MainWindow(tk.Frame):
         else:
             return False
 
+    def validate_cosmic_ray_threshold(self, after):
+        return is_num(after) or after == ''
+
+    def get_cosmic_ray_threshold(self) -> float:
+        # 入力欄の閾値．空欄や0以下なら既定の値
+        try:
+            threshold = self.cosmic_ray_threshold.get()
+        except tk.TclError:  # 空欄
+            return COSMIC_RAY_THRESHOLD
+        return threshold if threshold > 0 else COSMIC_RAY_THRESHOLD
+
+    def apply_cosmic_ray_threshold(self, event=None) -> None:
+        try:
+            threshold = self.cosmic_ray_threshold.get()
+        except tk.TclError:  # 空欄
+            return
+        if threshold <= 0 or self.processor is None or threshold == self.processor.threshold:
+            return
+        # 閾値を変えたときはマスクと置き換えだけ計算し直す
+        self.processor.set_threshold(threshold)
+        if self.map_manager.is_loaded and self.remove_cosmic_ray.get():
+            self.process()
+
     @check_map_loaded
     @check_ref_loaded
     def calibrate(self) -> None:
@@ -556,19 +722,32 @@ class MainWindow(tk.Frame):
         self.calibrator.set_material(self.material.get())
         self.calibrator.set_function(self.function.get())
         self.calibrator.reset_data()
-        if self.peak_selector.is_opened:  # ピーク選択ウィンドウが開いているときは手動でアサインしたものを採用
+        kwargs = {}
+        # 前に同じ条件でキャリブレーションしていれば，フィットせずにその結果（横軸）を使い，補正後のスペクトルを表示する
+        # ピーク選択ウィンドウが開いているときは手動でアサインしたものを採用し，フィットの結果を見るため必ずフィットし直す
+        use_cache = not self.peak_selector.is_opened
+        if self.peak_selector.is_opened:
             ranges, x_true = self.peak_selector.get_range_and_x()
-            ok = self.calibrator.calibrate(mode='manual', ranges=ranges, x_true=x_true)
+            kwargs = dict(mode='manual', ranges=ranges, x_true=x_true)
+        if len(self.ref_paths) > 1:
+            # 最初のリファレンスをマップの最初の行，最後のリファレンスを最後の行で測定したとみなして補間する
+            n_rows = self.map_manager.map_info.shape[0]
+            positions = np.linspace(0, n_rows - 1, len(self.ref_paths))
+            ok = self.calibrator.calibrate_drift(self.ref_paths, positions, n_rows, use_cache=use_cache, **kwargs)
         else:
-            ok = self.calibrator.calibrate()
+            ok = self.calibrator.calibrate(use_cache=use_cache, **kwargs)
         if not ok:
             messagebox.showerror('Error', 'Calibration failed.')
             return
         self.button_calibrate.config(state=tk.DISABLED)
+        self.calibrator.save_calibration(self.ref_paths)
         self.show_ref()
-        self.map_manager.update_xdata(self.calibrator.xdata)
+        self.map_manager.update_xdata(self.calibrator.xdata, self.calibrator.row_xdata)
+        self.map_manager.precompute_band_maps()  # 横軸が変わったのでプリセットのマップを計算し直す
+        self.refresh_map()
         self.update_plot()
         self.canvas.draw()
+        self.update_memory_report()
 
     @check_map_loaded
     def on_press(self, event: matplotlib.backend_bases.MouseEvent) -> None:
@@ -580,28 +759,57 @@ class MainWindow(tk.Frame):
             if self.toolbar._buttons['Zoom'].var.get() or self.toolbar._buttons['Pan'].var.get():
                 return
             self.map_manager.on_click(event.xdata, event.ydata)
-            self.update_plot()
+            self.request_update_plot()
         elif event.inaxes == self.ax_ref:  # ピークの矩形選択のため
             self.peak_selector.on_press(event)
 
     @check_map_loaded
     def key_pressed(self, event: matplotlib.backend_bases.KeyEvent) -> None:
         self.map_manager.on_key_press(event.key)
-        self.update_plot()
+        self.request_update_plot()
+
+    def request_update_plot(self) -> None:
+        # キーを押し続けると描画が追いつかずにイベントがたまるので，
+        # イベントを処理し終わってから最新の位置だけを描画する
+        if self.is_plot_pending:
+            return
+        self.is_plot_pending = True
+        self.after_idle(self.update_plot_pending)
+
+    def update_plot_pending(self) -> None:
+        self.is_plot_pending = False
+        if self.map_manager.is_loaded:
+            self.update_plot()
 
     @check_map_loaded
     def select_map_range_preset(self, *args) -> None:
-        x1, x2 = map(int, self.map_range.get().split('~'))
+        x1, x2 = (int(x) if x.is_integer() else x for x in parse_map_range(self.map_range.get()))
         self.map_range_1.set(x1)
         self.map_range_2.set(x2)
         self.map_manager.update_map(map_range=(x1, x2))
         self.canvas.draw()
 
+    @check_map_loaded
+    def pin_map_range(self) -> None:
+        # 今の範囲をプリセットに追加し，他のプリセットと一緒に計算しておくようにする
+        map_range = (self.map_range_1.get(), self.map_range_2.get())
+        self.map_manager.pin_map_range(map_range)
+        self.map_manager.precompute_band_maps()
+        pinned = [f'{x1:g}~{x2:g}' for x1, x2 in self.map_manager.pinned_ranges]
+        self.map_range.set(f'{map_range[0]:g}~{map_range[1]:g}')
+        self.optionmenu_map_range.set_menu(self.map_range.get(), *self.map_manager.map_range_list, *pinned)
+
     @check_map_loaded
     def on_change_map_range(self, *args) -> None:
         self.map_manager.update_map(map_range=(self.map_range_1.get(), self.map_range_2.get()))
         self.canvas.draw()
 
+    def refresh_map(self) -> None:
+        # map_dataかxdataが変わったのでマップを描き直す（描画はしない）
+        cmap_range = self.map_manager.refresh_map()
+        self.cmap_range_1.set(round(cmap_range[0]))
+        self.cmap_range_2.set(round(cmap_range[1]))
+
     @check_map_loaded
     def on_change_cmap_settings(self, *args) -> None:
         if self.map_autoscale.get():
@@ -633,54 +841,99 @@ class MainWindow(tk.Frame):
         # マッピング上のクロスヘアを移動
         self.map_manager.show_crosshair = self.show_crosshair.get()
         self.map_manager.update_crosshair()
-        self.canvas.draw()
+        self.blit()
 
     @check_map_loaded
     def update_plot(self) -> None:
+        iy, ix = self.map_manager.row, self.map_manager.col
+        xdata, ydata = self.map_manager.get_spectrum()
         if self.line is None:
             self.ax_raw.autoscale(True)
-        elif self.spec_autoscale.get():
-            self.ax_raw.autoscale(True)
-            self.line[0].remove()
-            self.ax_raw.cla()
-            self.ax_raw.set_title('Spectrum', fontsize=30)
+            self.line = self.ax_raw.plot(xdata, ydata, label=f'({ix}, {iy})', color='r', linewidth=0.8)
         else:
-            self.ax_raw.autoscale(False)
-            self.line[0].remove()
-        iy, ix = self.map_manager.row, self.map_manager.col
-        self.line = self.ax_raw.plot(
-            *self.map_manager.get_spectrum(),
-            label=f'({ix}, {iy})', color='r', linewidth=0.8)
+            # 線を作り直さずにデータだけ差し替える
+            self.line[0].set_data(xdata, ydata)
+            self.line[0].set_label(f'({ix}, {iy})')
+            if self.spec_autoscale.get():
+                self.ax_raw.relim()
+                self.ax_raw.autoscale(True)
+            else:
+                self.ax_raw.autoscale(False)
         self.ax_raw.legend(fontsize=18)
-        self.canvas.draw()
+        self.blit()
+
+    def get_animated_artists(self) -> list:
+        # 背景とは別に描画するもの．スペクトルは目盛りも変わるのでaxesごと描き直す
+        return [self.ax_raw] + self.map_manager.get_animated_artists()
+
+    def on_draw(self, event: matplotlib.backend_bases.DrawEvent) -> None:
+        # 全体を描画したとき（マップの更新，ズーム，ウィンドウのリサイズなど）に背景を保存し直す
+        if event is not None and event.canvas is not self.canvas:  # 画像の保存など別のcanvasへの描画
+            return
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.draw_animated()
+
+    def draw_animated(self) -> None:
+        for artist in self.get_animated_artists():
+            self.canvas.figure.draw_artist(artist)
+
+    def blit(self) -> None:
+        # 光学像やマップは描き直さず，保存しておいた背景の上にクロスヘアとスペクトルだけを描く
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
 
     @check_map_loaded
     def update_selection(self):
-        for r in self.selection_patches:
-            r.remove()
-        self.selection_patches = []
-        for child in self.treeview.get_children():
-            col, row = self.treeview.item(child)['values']
-            xc, yc = self.map_manager.idx2coord(row, col)  # center of the pixel
-            xp, yp = self.map_manager.map_info.map_pixel  # pixel size
-            x0 = xc - xp / 2
-            y0 = yc - yp / 2
-            r = patches.Rectangle((x0, y0), xp, yp, fill=False, edgecolor='white', lw=1)
-            self.ax_map.add_patch(r)
-            self.selection_patches.append(r)
-
-        if not self.show_selection_in_map.get():
-            for r in self.selection_patches:
-                r.set_visible(False)
+        self.map_manager.set_selection_visible(self.show_selection_in_map.get())
+        self.canvas.draw_idle()
+
+    def refresh_treeview(self, page: int | None = None) -> None:
+        # 保存リストの表示を作り直す．点が多いときはTREEVIEW_PAGE点ずつのページに分け，pageのページを並べる
+        # pageを省略すると今のページ（点が減って無くなっていれば最後のページ）
+        last_page = max(0, (self.selection.count - 1) // TREEVIEW_PAGE)
+        self.treeview_page = min(max(self.treeview_page if page is None else page, 0), last_page)
+        start = self.treeview_page * TREEVIEW_PAGE
+        self.treeview.delete(*self.treeview.get_children())
+        for ix, iy in self.selection.indices()[start:start + TREEVIEW_PAGE]:
+            self.treeview.insert('', tk.END, iid=f'{ix}_{iy}', text='', values=(ix, iy))
+        self.update_selection_count()
+
+    def move_treeview_page(self, step: int) -> None:
+        self.refresh_treeview(self.treeview_page + step)
+        self.treeview.yview_moveto(0)
+
+    def update_memory_report(self) -> None:
+        # 読み込んだデータと派生データが持っているメモリ．詳細はツールチップに表示する
+        report = self.map_manager.memory_report()
+        total = sum(report.values())
+        self.memory_usage.set(f'Memory: {total / 2 ** 20:.0f} MiB')
+        lines = []
+        for key, size in report.items():
+            if size > 0:
+                name = ' '.join(map(str, key)) if isinstance(key, tuple) else key
+                lines.append(f'{name}: {size / 2 ** 20:.1f} MiB')
+        self.tooltip_memory.set('\n'.join(lines) if lines else 'not loaded')
+
+    def update_selection_count(self) -> None:
+        count = self.selection.count
+        if count > TREEVIEW_PAGE:
+            start = self.treeview_page * TREEVIEW_PAGE
+            self.selection_count.set(f'{count} points ({start + 1}-{min(start + TREEVIEW_PAGE, count)})')
         else:
-            for r in self.selection_patches:
-                r.set_visible(True)
-        self.canvas.draw()
+            self.selection_count.set(f'{count} points')
+        last_page = max(0, (count - 1) // TREEVIEW_PAGE)
+        self.button_prev_page.config(state=tk.ACTIVE if self.treeview_page > 0 else tk.DISABLED)
+        self.button_next_page.config(state=tk.ACTIVE if self.treeview_page < last_page else tk.DISABLED)
 
     def select_from_treeview(self, *args):
         if self.treeview.focus() == '':
             return
-        self.row, self.col = self.treeview.item(self.treeview.focus())['values'][::-1]
+        col, row = self.treeview.item(self.treeview.focus())['values']
+        self.map_manager.set_index(row, col)
         self.update_crosshair()
         self.update_plot()
 
@@ -707,40 +960,159 @@ class MainWindow(tk.Frame):
             if dropped_place < threshold:
                 self.load_raw(filepath)
             else:
-                self.load_ref(filepath)
+                self.load_refs(paths)
         elif self.mode == 'Raman488':
             if dropped_place < threshold * 2 / 3:
                 self.load_raw(filepath)
             elif dropped_place < threshold * 4 / 3:
-                self.load_ref(filepath)
+                self.load_refs(paths)
             else:
                 self.load_bg(filepath)
 
+    def wait_for_task(self, kind: str, retry: Callable[[], None]) -> bool:
+        # 別の種類の処理が動いていれば，retryを待たせてTrueを返す．呼んだ側は何も変えずに戻る
+        # 同じ種類の処理ならrun_in_backgroundで置き換えるのでFalse
+        if self.task is None or self.task.kind == kind:
+            return False
+        self.pending_tasks[kind] = retry
+        return True
+
+    def run_pending_tasks(self) -> None:
+        # 待たせていた処理を頼まれた順にやり直す．どれかが別スレッドで動き始めたら残りはその後
+        while self.task is None and self.pending_tasks:
+            kind = next(iter(self.pending_tasks))
+            self.pending_tasks.pop(kind)()
+
+    def run_in_background(self, kind: str, work, on_done, on_cancel=None, cleanup=None) -> None:
+        # 重い処理を別スレッドで実行し，終わったらTkのメインループでon_doneを呼ぶ
+        # workは進捗を知らせる関数を受け取る．キャンセルされていたらその関数がCancelledを送出する
+        # 別の種類の処理が動いているときは，呼ぶ前にwait_for_taskで待たせておくこと
+        assert self.task is None or self.task.kind == kind
+        self.cancel_task(replaced=True)
+        self.pending_tasks.pop(kind, None)  # 待っていた同じ種類の処理はこれで済む
+        task = BackgroundTask(kind, work, on_done, on_cancel, cleanup)
+        self.task = task
+        self.progress_text.set('')
+        self.frame_progress.grid()
+        self.progressbar.start(20)
+        task.start()
+        self.after(50, self.poll_task, task)
+
+    def poll_task(self, task: 'BackgroundTask') -> None:
+        # 別スレッドからの知らせを処理する
+        while not task.messages.empty():
+            kind, value = task.messages.get()
+            if task.cancelled.is_set():
+                continue
+            if kind == 'progress':
+                self.progress_text.set(value)
+                continue
+            self.finish_task(task)
+            if kind == 'error':
+                messagebox.showerror('Error', str(value))
+                if task.cleanup is not None:
+                    task.cleanup()
+            elif kind == 'done':
+                task.on_done(value)
+            self.run_pending_tasks()
+            return
+        if task.is_alive() or not task.messages.empty():
+            self.after(50, self.poll_task, task)
+        elif task.cancelled.is_set():
+            # スレッドが止まったので，workが使っていたものを片付けてよい
+            self.finish_task(task)
+            if task.cleanup is not None:
+                task.cleanup()
+
+    def cancel_task(self, replaced: bool = False) -> None:
+        # 実行中の処理を中断する．スレッドは次の区切りで止まり，結果は捨てられる
+        # replaced: 新しい処理に置き換えるための中断（on_cancelは呼ばない）
+        # ユーザーが中止したときは待たせていた処理も捨てる
+        if not replaced:
+            self.pending_tasks.clear()
+        task = self.task
+        if task is None:
+            return
+        task.cancelled.set()
+        self.finish_task(task)
+        if task.on_cancel is not None and not replaced:
+            task.on_cancel()
+
+    def finish_task(self, task: 'BackgroundTask') -> None:
+        if self.task is not task:
+            return
+        self.task = None
+        self.progressbar.stop()
+        self.frame_progress.grid_remove()
+
     def load_raw(self, filepath: Path) -> None:
+        self.cancel_task()
         self.reset()
 
         if filepath.suffix == '.wdf':
-            self.calibrator = RenishawCalibrator()
-            self.mode = 'Renishaw'
-            self.forget_Raman488_widgets()
-            self.peak_selector.close_assign_window()
+            mode = 'Renishaw'
         elif filepath.suffix == '.hdf5':
-            self.mode = 'Raman488'
-            self.calibrator = Raman488Calibrator()
-            self.remember_Raman488_widgets()
+            mode = 'Raman488'
         else:
             messagebox.showerror('Error', 'Only .wdf or .hdf5 files are acceptable.')
             return
+        calibrator_class, processor_class = import_backend(mode)
+        calibrator = calibrator_class()
+        threshold = self.get_cosmic_ray_threshold()  # 最初のファイルを開く前に入力したものも使う
+        band_ranges = self.map_manager.get_band_ranges()
+
+        def work(progress):
+            # Tkには触らない
+            progress(f'Loading {filepath.name}...')
+            ok, map_info = calibrator.load_raw(filepath)
+            if not ok:
+                return None
+            processor = None
+            if mode == 'Raman488':
+                processor = processor_class(map_info=map_info, threshold=threshold, calibrator=calibrator)
+            # 前に開いたときのキャリブレーションがサイドカーキャッシュにあれば戻す（ドリフト補正はon_raw_loadedで行う）
+            # ドリフト補正の補間もここで済ませる
+            uncorrected = None
+            if calibrator.restore_calibration():
+                progress('Restoring calibration...')
+                uncorrected = map_info.update_xdata(calibrator.xdata, calibrator.row_xdata)
+            progress('Preparing map...')
+            # 累積和とプリセットのマップをまとめて計算しておき（map_info.derivedに入る），切り替えたときにすぐ表示できるようにする
+            map_info.get_band_maps(band_ranges)
+            progress('Drawing...')
+            return map_info, processor, uncorrected
+
+        def on_done(result):
+            if result is None:
+                calibrator.close()
+                messagebox.showerror('Error', 'Choose map data.')
+                return
+            self.on_raw_loaded(filepath, mode, calibrator, *result)
 
-        self.calibrator.set_ax(self.ax_ref)
-        ok, map_info = self.calibrator.load_raw(filepath)
-        if not ok:
-            messagebox.showerror('Error', 'Choose map data.')
-            return
-        self.map_manager.load(map_info)
+        self.run_in_background('raw', work, on_done, cleanup=calibrator.close)
 
-        if self.mode == 'Raman488':
-            self.processor = Raman488DataProcessor(map_info=map_info)
+    def on_raw_loaded(self, filepath: Path, mode: str, calibrator: CalibrationManager, map_info: MapInfo,
+                      processor: 'Raman488DataProcessor | None', map_data_uncorrected: tuple | None = None) -> None:
+        self.calibrator = calibrator
+        self.mode = mode
+        if self.mode == 'Renishaw':
+            self.forget_Raman488_widgets()
+            self.peak_selector.close_assign_window()
+        elif self.mode == 'Raman488':
+            self.remember_Raman488_widgets()
+            self.processor = processor
+
+        self.calibrator.set_ax(self.ax_ref)
+        self.map_manager.load(map_info, map_data_uncorrected)
+        if self.calibrator.is_calibrated:  # サイドカーキャッシュから戻したキャリブレーション（横軸はworkで反映済み）
+            self.ref_paths = self.calibrator.restored_ref_paths
+            self.folder_ref = self.ref_paths[0].parent
+            self.filename_ref.set(f'{self.ref_paths[0].name} (cached)' if len(self.ref_paths) == 1
+                                  else f'{self.ref_paths[0].name} (+{len(self.ref_paths) - 1}, cached)')
+            self.tooltip_ref.set(self.ref_paths[0])
+        self.selection.reset(map_info.shape)
+        self.refresh_treeview()
+        self.map_manager.set_selection(self.selection.mask)
 
         self.filename_raw.set(filepath.name)
         self.folder_raw = filepath.parent
@@ -750,47 +1122,108 @@ class MainWindow(tk.Frame):
         self.on_change_cmap_settings()
         self.update_plot()
         self.tooltip_raw.set(filepath)
+        self.update_memory_report()
+
+    def load_refs(self, paths: list[Path]) -> None:
+        # 複数のリファレンスをまとめてドロップしたときはドリフト補正に使う
+        # ファイル名の順（中の数字は数として比べる）を測定順とみなして並べ，最初のものを表示する．
+        # 更新日時はコピーしただけで変わるので使わない
+        if len(paths) == 1:
+            self.load_ref(paths[0])
+            return
+        paths = sorted(paths, key=lambda p: natural_key(p.name))
+        self.load_ref(paths[0], ref_paths=paths)
 
-    def load_ref(self, filepath: Path) -> None:
+    def load_ref(self, filepath: Path, ref_paths: list[Path] = None) -> None:
+        # マッピングを読み込んでいる途中なら，読み終わってから確かめる
+        if self.wait_for_task('ref', lambda: self.load_ref(filepath, ref_paths)):
+            return
         if self.calibrator.reader_raw is None:
             messagebox.showerror('Error', 'Choose map data first.')
             return
 
         # ファイル形式を確認
+        ref_paths = ref_paths or [filepath]
         if self.mode == 'Renishaw':
-            if filepath.suffix != '.wdf':
+            if any(p.suffix != '.wdf' for p in ref_paths):
                 messagebox.showerror('Error', 'Only .wdf files are acceptable.')
                 return
         elif self.mode == 'Raman488':
-            if filepath.suffix != '.hdf5':
+            if any(p.suffix != '.hdf5' for p in ref_paths):
                 messagebox.showerror('Error', 'Only .hdf5 files are acceptable.')
                 return
 
         self.calibrator.reset_ref()
-        has_same_xdata = self.calibrator.load_ref(filepath)
-        if not has_same_xdata:
-            messagebox.showerror('Error',
-                                 'X-axis data does not match. Choose reference data with same measurement condition as the map data.')
-            return
-        self.filename_ref.set(filepath.name)
-        self.folder_ref = filepath.parent
-        for material in self.calibrator.get_material_list():
-            if material in filepath.name:
-                self.material.set(material)
-        self.button_calibrate.config(state=tk.ACTIVE)
+        self.filename_ref.set('please drag & drop!')
+        self.ref_paths = []
+        self.button_calibrate.config(state=tk.DISABLED)
 
-        self.peak_selector.reset()
+        calibrator = self.calibrator
+
+        def work(progress):
+            # 読み込むだけで，calibratorの状態はon_doneで変える．
+            # ドリフト補正に使うリファレンスも全て，マッピングと横軸が合うかここで確かめる
+            reader_ref = None
+            for p in ref_paths:
+                progress(f'Loading {p.name}...')
+                reader = calibrator.read_ref(p)
+                if not calibrator.check_ref(reader):
+                    reader.close()
+                    if reader_ref is not None:
+                        reader_ref.close()
+                    return None, p
+                if reader_ref is None:
+                    reader_ref = reader
+                else:
+                    reader.close()
+            return reader_ref, None
+
+        def on_done(result):
+            reader_ref, mismatched = result
+            if mismatched is not None or not calibrator.set_ref(reader_ref):
+                messagebox.showerror('Error',
+                                     f'X-axis data of {(mismatched or filepath).name} does not match. '
+                                     'Choose reference data with same measurement condition as the map data.')
+                return
+            self.ref_paths = ref_paths
+            self.filename_ref.set(filepath.name if len(ref_paths) == 1 else f'{filepath.name} (+{len(ref_paths) - 1})')
+            self.folder_ref = filepath.parent
+            for material in self.calibrator.get_material_list():
+                if material in filepath.name:
+                    self.material.set(material)
+            self.button_calibrate.config(state=tk.ACTIVE)
 
-        self.show_ref()
-        self.tooltip_ref.set(filepath)
+            self.peak_selector.reset()
+
+            self.show_ref()
+            self.tooltip_ref.set(filepath)
+
+        self.run_in_background('ref', work, on_done)
 
     def load_bg(self, filepath: Path) -> None:
-        self.filename_bg.set(filepath.name)
-        self.folder_bg = filepath.parent
-        self.tooltip_bg.set(filepath)
-        self.processor.load_bg(filepath)
-        self.subtract_bg.set(True)
-        self.process()
+        if self.wait_for_task('bg', lambda: self.load_bg(filepath)):
+            return
+        if self.processor is None or not self.map_manager.is_loaded:
+            messagebox.showerror('Error', 'Choose map data first.')
+            return
+        processor = self.processor
+
+        def work(progress):
+            # 読み込むだけで，processorの状態はon_doneで変える
+            progress(f'Loading {filepath.name}...')
+            return processor.read_bg(filepath)
+
+        def on_done(bg_data):
+            processor.set_bg(bg_data)
+            self.filename_bg.set(filepath.name)
+            self.folder_bg = filepath.parent
+            self.tooltip_bg.set(filepath)
+            self.subtract_bg.set(True)
+            if processor is not self.processor:  # 別のファイルが開かれている
+                return
+            self.process()
+
+        self.run_in_background('bg', work, on_done)
 
     def drop_enter(self, event: TkinterDnD.DnDEvent) -> None:
         if self.mode == 'Renishaw':
@@ -807,6 +1240,8 @@ class MainWindow(tk.Frame):
         self.label_bg.grid_forget()
         self.label_filename_bg.grid_forget()
         self.checkbox_remove_cosmic_ray.grid_forget()
+        self.label_cosmic_ray_threshold.grid_forget()
+        self.entry_cosmic_ray_threshold.grid_forget()
         self.button_assign_manually.grid_forget()
 
     def remember_Raman488_widgets(self) -> None:
@@ -814,60 +1249,101 @@ class MainWindow(tk.Frame):
         self.label_filename_bg.grid(row=2, column=1)
         self.checkbox_subtract_bg.grid(row=3, column=0, columnspan=2)
         self.checkbox_remove_cosmic_ray.grid(row=4, column=0, columnspan=2)
+        self.label_cosmic_ray_threshold.grid(row=5, column=0)
+        self.entry_cosmic_ray_threshold.grid(row=5, column=1)
         self.button_assign_manually.grid(row=1, column=0)
 
     def process(self) -> None:
         # バックグラウンド，宇宙線除去
+        # 読み込みの途中なら，終わってからその時のチェックでやり直す
+        if self.wait_for_task('process', self.process):
+            return
+        if self.processor is None or not self.map_manager.is_loaded:
+            self.subtract_bg.set(False)
+            self.remove_cosmic_ray.set(False)
+            return
         if self.subtract_bg.get() and self.processor.bg_data is None:
             messagebox.showerror('Error', 'Choose background data.')
             self.subtract_bg.set(False)
             return
+        if self.remove_cosmic_ray.get() and not self.processor.has_crr_data():
+            # 宇宙線除去は重いので別スレッドで計算し，結果をこのスレッドで置いてからやり直す
+            processor = self.processor
+            threshold = processor.threshold
+
+            def work(progress):
+                progress('Removing cosmic rays...')
+                return processor.compute_crr_data(threshold)
+
+            def on_done(results):
+                if processor is not self.processor:  # 別のファイルが開かれている
+                    return
+                processor.store_crr_data(results)
+                self.process()
+
+            # ユーザーが中止したときだけチェックを外す（別の処理に置き換えられたときはその処理に任せる）
+            self.run_in_background('process', work, on_done, on_cancel=lambda: self.remove_cosmic_ray.set(False))
+            return
         self.processor.set_processed_data(is_bg_subtracted=self.subtract_bg.get(), is_cosmic_ray_removed=self.remove_cosmic_ray.get())
+        if self.calibrator.row_xdata is not None:  # 処理し直したデータにドリフト補正をかけ直す
+            self.map_manager.map_data_uncorrected = None
+            self.map_manager.update_xdata(self.calibrator.xdata, self.calibrator.row_xdata)
+        self.map_manager.precompute_band_maps()
+        self.refresh_map()
         self.update_plot()
         self.canvas.draw()
+        self.update_memory_report()
 
     def reset(self) -> None:
         self.calibrator.close()
         self.calibrator.reset()
         self.calibrator = CalibrationManager()
-        self.processor.reset()
+        if self.processor is not None:
+            self.processor.reset()
         self.map_manager.reset()
         self.map_manager.map_range = (self.map_range_1.get(), self.map_range_2.get())
         self.filename_raw.set('please drag & drop!')
         self.filename_ref.set('please drag & drop!')
         self.filename_bg.set('not loaded')
+        self.update_memory_report()
         self.folder_raw = Path('./')
         self.folder_ref = Path('./')
         self.folder_bg = Path('./')
+        self.ref_paths = []
         self.forget_Raman488_widgets()
         self.button_calibrate.config(state=tk.DISABLED)
-        self.row = 0
-        self.col = 0
 
-        self.treeview.delete(*self.treeview.get_children())
+        self.selection.reset()
+        self.refresh_treeview()
 
     @check_map_loaded
     def add(self) -> None:
-        # 保存リストに追加する
-        index = (self.map_manager.col, self.map_manager.row)  # (x, y)
-
-        # 既に追加されている場合は追加しない
-        for child in self.treeview.get_children():
-            if self.treeview.item(child)['values'] == list(index):
-                return
-        self.treeview.insert('', tk.END, text='', values=index)
-        self.treeview.yview_moveto(1)
-        self.update_selection()
+        # 保存リストに追加する．既に追加されている場合は追加しない
+        row, col = self.map_manager.row, self.map_manager.col
+        if not self.selection.add(row, col):
+            return
+        # 追加した点が入るページを表示する．今のページならその位置に差し込み，はみ出した点は次のページに回す
+        position = self.selection.position(row, col)
+        page = position // TREEVIEW_PAGE
+        if page == self.treeview_page:
+            self.treeview.insert('', position - page * TREEVIEW_PAGE, iid=f'{col}_{row}', text='', values=(col, row))
+            children = self.treeview.get_children()
+            if len(children) > TREEVIEW_PAGE:
+                self.treeview.delete(children[-1])
+            self.update_selection_count()
+        else:
+            self.refresh_treeview(page)
+        self.treeview.see(f'{col}_{row}')
+        self.map_manager.set_selected(row, col, True)
+        self.canvas.draw_idle()
 
     @check_map_loaded
     def add_all(self) -> None:
         # 全ての点を保存リストに追加
-        all_indices = [[idx2, idx1] for idx2 in range(self.map_manager.map_info.shape[1]) for idx1 in
-                       range(self.map_manager.map_info.shape[0])]
-        self.treeview.delete(*self.treeview.get_children())
-        for index in all_indices:
-            self.treeview.insert('', tk.END, text='', values=index)
-        self.update_selection()
+        self.selection.add_all()
+        self.refresh_treeview()
+        self.map_manager.set_selection(self.selection.mask)
+        self.canvas.draw_idle()
 
     @check_map_loaded
     def delete(self, event=None) -> None:
@@ -880,33 +1356,43 @@ class MainWindow(tk.Frame):
         idx_to_delete = [self.treeview.item(iid)['values'] for iid in self.treeview.selection()]
         # 何も選択されていない場合、現在の点を削除
         if len(idx_to_delete) == 0:
-            idx_to_delete = [(self.col, self.row)]
-
-        for child in self.treeview.get_children():
-            if self.treeview.item(child)['values'] in idx_to_delete:
-                self.treeview.delete(child)
-
-        self.update_selection()
+            idx_to_delete = [(self.map_manager.col, self.map_manager.row)]
+
+        is_paged = self.selection.count > TREEVIEW_PAGE
+        for col, row in idx_to_delete:
+            if self.selection.remove(row, col):
+                self.map_manager.set_selected(row, col, False)
+        if is_paged:  # 後ろのページの点を詰めて並べ直す
+            self.refresh_treeview()
+        else:
+            for col, row in idx_to_delete:
+                if self.treeview.exists(f'{col}_{row}'):
+                    self.treeview.delete(f'{col}_{row}')
+            self.update_selection_count()
+        self.canvas.draw_idle()
 
     @check_map_loaded
     def delete_all(self) -> None:
         # 保存リストから全て削除
         if not messagebox.askyesno('Confirmation', 'Delete all?'):
             return
-        self.treeview.delete(*self.treeview.get_children())
-        self.update_selection()
+        self.selection.clear()
+        self.refresh_treeview()
+        self.map_manager.set_selection(self.selection.mask)
+        self.canvas.draw_idle()
 
     def construct_filename(self, ix: int, iy: int) -> str:
-        filepath = Path(self.filename_raw.get())
-        ny, nx = self.map_manager.map_info.shape
-        # 0埋め
-        ix = str(ix).zfill(len(str(nx)))
-        iy = str(iy).zfill(len(str(ny)))
-        return filepath.with_name(f'{filepath.stem}_{ix}_{iy}.txt').name
+        return construct_filename(Path(self.filename_raw.get()).stem, ix, iy, self.map_manager.map_info.shape)
 
     def save(self) -> None:
         # 保存リスト内のファイルを保存
-        if not self.treeview.get_children():
+        if self.selection.count == 0:
+            return
+        ok, grid = self.get_grid()
+        if not ok:
+            return
+        if self.save_format.get() != 'txt':
+            self.save_spectra(grid)
             return
 
         # フォルダを選択
@@ -917,42 +1403,110 @@ class MainWindow(tk.Frame):
         folder_to_save = Path(folder_to_save)
 
         xdata = self.map_manager.map_info.xdata
-        for child in self.treeview.get_children():
-            col, row = self.treeview.item(child)['values']
-            spectrum = self.map_manager.map_info.map_data[row][col]
-            abs_path_raw = self.folder_raw / self.filename_raw.get()
-            if self.calibrator.is_calibrated:
-                abs_path_ref = self.folder_ref / self.filename_ref.get()
-            else:
-                abs_path_ref = ''
-            if self.subtract_bg.get():
-                abs_path_bg = self.folder_bg / self.filename_bg.get()
-            else:
-                abs_path_bg = ''
+        header = self.make_header(grid)
+        indices = self.selection.indices()  # (ix, iy)
+        spectra = None
+        if grid is not None:  # 選択した点をまとめて補間しておく
+            xdata = make_grid(*grid)
+            spectra = resample_spectra(self.map_manager.map_info.xdata, self.map_manager.map_info.map_data[indices[:, 1], indices[:, 0]], xdata,
+                                       dtype=self.map_manager.map_info.dtype)
+        for i, (col, row) in enumerate(indices):
+            spectrum = self.map_manager.map_info.map_data[row, col] if spectra is None else spectra[i]
             filepath = folder_to_save / self.construct_filename(ix=col, iy=row)
             if filepath.exists():
                 if not messagebox.askyesno('Confirmation', f'{filepath.name} already exists. Overwrite?'):
                     continue
-            with filepath.open('w') as f:
-                f.write(f'# abs_path_raw: {abs_path_raw}\n')
-                f.write(f'# abs_path_ref: {abs_path_ref}\n')
-                if self.mode == 'Raman488':
-                    f.write(f'# abs_path_bg: {abs_path_bg}\n')
-                    f.write(f'# cosmic_ray_removed: {"Yes" if self.remove_cosmic_ray.get() else "No"}\n')
-                f.write(f'# calibration: {self.calibrator.calibration_info}\n\n')
-
-                for x, y in zip(xdata, spectrum):
-                    f.write(f'{x},{y}\n')
+            write_spectrum(filepath, xdata, spectrum, header)
+
+    def save_spectra(self, grid: tuple = None) -> None:
+        # 保存リスト内のスペクトルを1つのファイルにまとめて保存
+        ext = '.' + self.save_format.get()
+        filename = filedialog.asksaveasfilename(initialdir=self.folder_raw, initialfile=Path(self.filename_raw.get()).stem + ext,
+                                                defaultextension=ext, filetypes=[(ext[1:], '*' + ext)])
+        if not filename:
+            return
+        indices = self.selection.indices()  # (ix, iy)
+        xdata = self.map_manager.map_info.xdata
+        spectra = self.map_manager.map_info.map_data[indices[:, 1], indices[:, 0]]
+        if grid is not None:
+            xdata = make_grid(*grid)
+            spectra = resample_spectra(self.map_manager.map_info.xdata, spectra, xdata, dtype=self.map_manager.map_info.dtype)
+        try:
+            write_spectra(Path(filename).with_suffix(ext), xdata, spectra, indices,
+                          self.map_manager.map_info.shape, self.make_header(grid))
+        except ImportError as e:
+            messagebox.showerror('Error', str(e))
+
+    def get_grid(self) -> [bool, tuple | None]:
+        # Resampleがオンなら，補間先の横軸の (start, stop, step)
+        if not self.resample.get():
+            return True, None
+        try:
+            grid = (self.grid_start.get(), self.grid_stop.get(), self.grid_step.get())
+        except tk.TclError:  # 数値でない
+            grid = None
+        if grid is None or grid[0] >= grid[1] or grid[2] <= 0:
+            messagebox.showerror('Error', 'Invalid resampling grid.')
+            return False, None
+        return True, grid
+
+    def make_header(self, grid: tuple = None) -> dict:
+        abs_path_raw = self.folder_raw / self.filename_raw.get()
+        if self.calibrator.is_calibrated and len(self.ref_paths) > 1:  # ドリフト補正
+            abs_path_ref = ', '.join(str(p.resolve()) for p in self.ref_paths)
+        elif self.calibrator.is_calibrated:
+            abs_path_ref = self.ref_paths[0]
+        else:
+            abs_path_ref = ''
+        if self.subtract_bg.get():
+            abs_path_bg = self.folder_bg / self.filename_bg.get()
+        else:
+            abs_path_bg = ''
+        return make_header(abs_path_raw, abs_path_ref, self.calibrator.calibration_info,
+                           is_raman488=self.mode == 'Raman488', abs_path_bg=abs_path_bg,
+                           cosmic_ray_removed=self.remove_cosmic_ray.get(), grid=grid)
 
     def quit(self) -> None:
+        self.cancel_task()
         self.calibrator.close()
         self.master.quit()
         self.master.destroy()
 
 
+instrumentation.register(MainWindow, 'calibrate', 'update_plot', 'blit', 'on_raw_loaded', 'process', 'save')
+instrumentation.register(FigureCanvasTkAgg, 'draw')
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Calibrate Raman mapping data.')
+    parser.add_argument('--trace', nargs='?', const=instrumentation.DEFAULT_TRACE_PATH, metavar='PATH',
+                        help='measure the time of each stage and write a Chrome trace JSON ({pid} is replaced by the process ID)')
+    parser.add_argument('--precision', choices=PRECISIONS, default=float_dtype().name,
+                        help='float type of spectra and maps. float32 halves the memory for large maps')
+    parser.add_argument('--memory-limit', type=float, default=get_memory_limit() / 2 ** 20, metavar='MiB',
+                        help='memory for the loaded data and the data computed from it; computed data is freed above this')
+    parser.add_argument('--sidecar-cache', nargs='?', const='next', default=get_sidecar_location(), metavar='DIR',
+                        help='save opened maps, cosmic ray removal and calibration, and reopen them from the cache; '
+                             'without DIR the cache is put next to each map file')
+    parser.add_argument('--sidecar-limit', type=float, default=get_sidecar_limit() / 2 ** 20, metavar='MiB',
+                        help='size of each sidecar cache folder; the least recently used files are deleted above this')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='print the time to import modules and to draw the window for the first time, then quit')
+    args = parser.parse_args()
+    set_precision(args.precision)
+    set_memory_limit(int(args.memory_limit * 2 ** 20))
+    set_sidecar(args.sidecar_cache, int(args.sidecar_limit * 2 ** 20))
+    if args.trace is not None:
+        instrumentation.enable(args.trace)
+
     root = TkinterDnD.Tk()
     app = MainWindow(master=root)
+    if args.startup_time:
+        def on_first_draw(event):
+            app.canvas.mpl_disconnect(cid)
+            print(f'import: {IMPORT_TIME - START_TIME:.3f} s, first paint: {time.perf_counter() - START_TIME:.3f} s')
+            root.after_idle(app.quit)
+        cid = app.canvas.mpl_connect('draw_event', on_first_draw)
     root.protocol('WM_DELETE_WINDOW', app.quit)
     root.drop_target_register(DND_FILES)
     root.dnd_bind('<<DropEnter>>', app.drop_enter)
@@ -0,0 +1,4 @@
+import time
+
+# 起動時間の計測用．main.pyで他のモジュールより前にimportし，importされた時刻を起動した時刻とみなす
+START_TIME = time.perf_counter()
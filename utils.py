@@ -1,31 +1,328 @@
+import os
+import re
 import numpy as np
 
+# スペクトルと，そこから計算するマップなどを持つ浮動小数点の型（'float64'または'float32'）．環境変数でも変えられる
+# float32にするとメモリと読み書きの量が半分になる（float64との差はREADMEを参照）
+PRECISION_ENV = 'RAMAN_CALIBRATOR_PRECISION'
+PRECISIONS = ('float64', 'float32')
+_precision = np.dtype(os.environ.get(PRECISION_ENV) or 'float64')
 
-def subtract_baseline(data: np.ndarray):
-    baseline = np.linspace(data[0], data[-1], data.shape[0])
-    return data - baseline
 
+def set_precision(precision: str) -> None:
+    global _precision
+    if precision not in PRECISIONS:
+        raise ValueError(f'precision must be one of {PRECISIONS}: {precision}')
+    _precision = np.dtype(precision)
 
-def remove_cosmic_ray(spectra: np.ndarray, threshold: float):
-    mean = spectra.mean(axis=2)
-    std = spectra.std()
-    deviation = (spectra - mean[:, :, np.newaxis, :]) / std
-    mask = np.where(deviation > threshold, 0, 1)
-    spectra_removed = spectra * mask
-    spectra_average = spectra_removed.sum(axis=2)[:, :, np.newaxis, :] / mask.sum(axis=2)[:, :, np.newaxis, :] * (1 - mask)
-    return spectra_removed + spectra_average
+
+def float_dtype(dtype=None) -> np.dtype:
+    # dtypeを指定すればその型，なければ既定の型．計算する関数はdtypeを受け取り，呼び出し側が持っている型を渡す
+    return np.dtype(dtype) if dtype is not None else _precision
+
+
+def as_float(data, dtype=None):
+    # float32のモードなら，それより大きい浮動小数点の配列をfloat32にする．それ以外はそのまま返す
+    dtype = float_dtype(dtype)
+    if isinstance(data, np.ndarray) and np.issubdtype(data.dtype, np.floating) and data.dtype.itemsize > dtype.itemsize:
+        return data.astype(dtype)
+    return data
+
+
+def subtract_baseline(data: np.ndarray, dtype=None):
+    # 最後の軸をスペクトルとみなし，両端を結ぶ直線をベースラインとして引く
+    # (x, y, スペクトル) の3次元データもまとめて処理できる
+    # float32のモードでは入力によらずfloat32で計算する（既定ではnumpyの型の規則のまま）
+    dtype = float_dtype(dtype) if float_dtype(dtype) != np.float64 else None
+    baseline = np.linspace(data[..., 0], data[..., -1], data.shape[-1], axis=-1, dtype=dtype)
+    # 1点ずつ処理していた頃と同じ順番で足し合わせられるよう，C順で確保する
+    return np.subtract(data, baseline, order='C', dtype=dtype)
+
+
+def integrate_band(data: np.ndarray, dtype=None):
+    # ベースラインを引いた後のスペクトルの和（バンド強度）を全点まとめて計算する
+    return subtract_baseline(data, dtype).sum(axis=-1)
+
+
+def cumsum_spectra(data: np.ndarray):
+    # 任意のバンド強度を素早く求めるための累積和．先頭に0を付けておく
+    # 端から足し続けるので，float32ではベースラインの高いスペクトルで桁が足りない．データの型によらずfloat64で持つ
+    cumsum = np.zeros(data.shape[:-1] + (data.shape[-1] + 1,), dtype=np.float64)
+    np.cumsum(data, axis=-1, out=cumsum[..., 1:])
+    return cumsum
+
+
+def integrate_band_from_cumsum(cumsum: np.ndarray, data: np.ndarray, start: int, stop: int, dtype=None):
+    # integrate_band(data[..., start:stop]) を累積和から求める
+    # 両端を結ぶ直線ベースラインの和は (点数) x (両端の平均) になる
+    n = stop - start
+    band = cumsum[..., stop] - cumsum[..., start] - n * (data[..., start].astype(np.float64) + data[..., stop - 1]) / 2
+    return band.astype(float_dtype(dtype), copy=False)
+
+
+class SubtractedSpectra:
+    # (..., スペクトル) のdataからoffset（スペクトル）を引いたものを，読み出した部分だけ計算して返す
+    # 背景の引き算を切り替えるたびに全体と同じ大きさの配列を作らずに済む
+    def __init__(self, data, offset: np.ndarray):
+        self.data = data
+        self.offset = offset
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.dtype = np.result_type(data.dtype, offset.dtype)
+        self.nbytes = 0  # dataと別にメモリは持たない
+
+    def __getitem__(self, key):
+        # 最後の軸（スペクトル）の指定でoffsetも切り出す．...は軸の数に合わせて展開する（np.newaxisには対応しない）
+        if not isinstance(key, tuple):
+            key = (key,)
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if ellipsis:
+            i = ellipsis[0]
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        channel = key[self.ndim - 1] if len(key) >= self.ndim else slice(None)
+        return self.data[key] - self.offset[channel]
+
+    def __array__(self, dtype=None, copy=None):
+        # 全体が必要になったときだけ計算する
+        data = np.asarray(self.data) - self.offset
+        return data if dtype is None else data.astype(dtype)
+
+
+# 4次元データを空間方向に分割して処理するときの一時配列の上限 [byte]
+CHUNK_MEMORY_LIMIT = 256 * 2 ** 20
+
+
+def _spatial_chunks(shape: tuple, bytes_per_pixel: int, memory_limit: int):
+    # (x, y, ...) の配列を，1ブロックの一時配列がmemory_limitに収まるよう空間方向に分割する
+    nx, ny = shape[:2]
+    pixels = max(1, memory_limit // max(1, bytes_per_pixel))
+    if pixels >= ny:  # xの行をまとめて処理できる
+        step_x, step_y = min(nx, pixels // ny), ny
+    else:  # 1行も収まらないのでyも分割する
+        step_x, step_y = 1, pixels
+    for x0 in range(0, nx, step_x):
+        for y0 in range(0, ny, step_y):
+            yield slice(x0, min(x0 + step_x, nx)), slice(y0, min(y0 + step_y, ny))
+
+
+def integrate_bands(data, bands: list, memory_limit: int = CHUNK_MEMORY_LIMIT, dtype=None) -> list:
+    # 複数のバンド強度マップを，(x, y, スペクトル) のデータを1回読むだけでまとめて計算する
+    # bands: 各バンドのチャンネル（sliceまたはインデックスの配列）
+    # 空間方向に分割して，全バンドを含むチャンネルだけを読むので，ディスク上のデータでも一時配列はmemory_limit程度
+    channels = [np.arange(data.shape[2])[band] for band in bands]
+    lo = min(c.min() for c in channels)
+    hi = max(c.max() for c in channels) + 1
+    dtype = float_dtype(dtype)
+    result = [np.empty(data.shape[:2], dtype=dtype) for _ in bands]
+    for sx, sy in _spatial_chunks(data.shape, (hi - lo) * dtype.itemsize * 2, memory_limit):
+        chunk = data[sx, sy, lo:hi]
+        for r, c in zip(result, channels):
+            r[sx, sy] = integrate_band(chunk[..., c - lo], dtype)
+    return result
+
+
+def _pixel_size(spectra) -> int:
+    # 1点あたりの要素数（積算 x スペクトル）
+    return int(np.prod(spectra.shape[2:]))
+
+
+def mean_accumulations(spectra, memory_limit: int = CHUNK_MEMORY_LIMIT, dtype=None):
+    # spectra.mean(axis=2) を分割して計算する．HDF5のデータセットのようにディスク上にあるものも扱える
+    dtype = float_dtype(dtype)
+    result = np.empty(spectra.shape[:2] + spectra.shape[3:], dtype=dtype)
+    for sx, sy in _spatial_chunks(spectra.shape, _pixel_size(spectra) * dtype.itemsize, memory_limit):
+        result[sx, sy] = spectra[sx, sy].mean(axis=2)
+    return result
+
+
+def spectra_std(spectra: np.ndarray, memory_limit: int = CHUNK_MEMORY_LIMIT, dtype=None):
+    # spectra.std() を，全体と同じ大きさの一時配列を作らずに求める．二乗和はfloat64で足し合わせる
+    dtype = float_dtype(dtype)
+    chunks = list(_spatial_chunks(spectra.shape, _pixel_size(spectra) * dtype.itemsize, memory_limit))
+    if isinstance(spectra, np.ndarray):
+        mean = spectra.mean()
+    else:  # ディスク上のデータは分割して読みながら平均をとる
+        mean = sum(spectra[sx, sy].sum() for sx, sy in chunks) / np.prod(spectra.shape)
+    chunk_shape = None
+    buffer = None
+    sum_sq = 0.0
+    for sx, sy in chunks:
+        if buffer is None:
+            chunk_shape = (sx.stop - sx.start, sy.stop - sy.start) + spectra.shape[2:]
+            buffer = np.empty(chunk_shape, dtype=dtype)
+        buf = buffer[:sx.stop - sx.start, :sy.stop - sy.start]
+        np.subtract(spectra[sx, sy], mean, out=buf, casting='unsafe')
+        np.square(buf, out=buf)
+        sum_sq += buf.sum(dtype=np.float64)
+    return np.sqrt(sum_sq / np.prod(spectra.shape))
+
+
+def remove_cosmic_ray(spectra: np.ndarray, threshold: float, average: bool = False, memory_limit: int = CHUNK_MEMORY_LIMIT,
+                      mean: np.ndarray = None, std: float = None, dtype=None):
+    # spectra: (x, y, 積算, スペクトル)．HDF5のデータセットのようにディスク上にあるものも扱える
+    # 積算の平均からのずれ（全体の標準偏差で規格化）がthresholdを超えた値を宇宙線とみなし，残りの積算の平均で置き換える
+    # 空間方向に分割して処理し，一時配列はmemory_limit程度に抑えて使い回す
+    # average=Trueなら積算方向の平均をとった (x, y, スペクトル) を返す．4次元の結果は確保しない
+    # 積算の平均 mean (x, y, スペクトル) と標準偏差 std を渡せば，閾値を変えるたびに計算し直さずに済む
+    if std is None:
+        std = spectra_std(spectra, memory_limit, dtype)
+    # ずれの計算は入力の精度，置き換えはdtype（既定のfloat64では以前の実装と同じ）で行う
+    dtype = float_dtype(dtype)
+    deviation_dtype = spectra.dtype if np.issubdtype(spectra.dtype, np.floating) else np.float64
+    separate_deviation = deviation_dtype != dtype
+    bytes_per_pixel = _pixel_size(spectra) * (dtype.itemsize + 2 + (np.dtype(deviation_dtype).itemsize if separate_deviation else 0))
+
+    if average:
+        result = np.empty(spectra.shape[:2] + spectra.shape[3:], dtype=dtype)
+    else:
+        result = np.empty(spectra.shape, dtype=dtype)
+    buffer = deviation_buffer = is_ray = is_kept = None
+    for sx, sy in _spatial_chunks(spectra.shape, bytes_per_pixel, memory_limit):
+        if buffer is None:
+            chunk_shape = (sx.stop - sx.start, sy.stop - sy.start) + spectra.shape[2:]
+            buffer = np.empty(chunk_shape, dtype=dtype)
+            deviation_buffer = np.empty(chunk_shape, dtype=deviation_dtype) if separate_deviation else buffer
+            is_ray = np.empty(chunk_shape, dtype=bool)
+            is_kept = np.empty(chunk_shape, dtype=bool)
+        size = (slice(0, sx.stop - sx.start), slice(0, sy.stop - sy.start))
+        chunk = spectra[sx, sy]
+        buf, deviation, ray, kept = buffer[size], deviation_buffer[size], is_ray[size], is_kept[size]
+        # 積算の平均からのずれ
+        chunk_mean = chunk.mean(axis=2, keepdims=True) if mean is None else mean[sx, sy][:, :, np.newaxis, :]
+        np.subtract(chunk, chunk_mean, out=deviation)
+        np.divide(deviation, std, out=deviation)
+        np.greater(deviation, threshold, out=ray)
+        np.logical_not(ray, out=kept)
+        # 宇宙線を0にして，残った積算の平均で置き換える
+        np.multiply(chunk, kept, out=buf, casting='unsafe')
+        replacement = buf.sum(axis=2, keepdims=True) / kept.sum(axis=2, keepdims=True)
+        np.copyto(buf, replacement, where=ray)
+        if average:
+            buf.mean(axis=2, out=result[sx, sy])
+        else:
+            result[sx, sy] = buf
+    return result
+
+
+def make_grid(start: float, stop: float, step: float) -> np.ndarray:
+    # start から stop まで（stopを含む）step 間隔の横軸
+    return start + step * np.arange(int(np.floor((stop - start) / step + 1e-9)) + 1, dtype=float)
+
+
+def _interpolation_weights(xdata: np.ndarray, grid: np.ndarray, extrapolate: bool):
+    # xdata上のスペクトルからgrid上の値を求めるための，両隣のチャンネルと重み
+    order = np.argsort(xdata, kind='stable')
+    x = xdata[order]
+    right = np.clip(np.searchsorted(x, grid), 1, len(x) - 1)
+    left = right - 1
+    dx = x[right] - x[left]
+    weight = np.divide(grid - x[left], dx, out=np.zeros_like(grid), where=dx != 0)
+    if extrapolate:  # 範囲外は端の値
+        np.clip(weight, 0, 1, out=weight)
+        outside = np.zeros(grid.shape, dtype=bool)
+    else:
+        outside = (grid < x[0]) | (grid > x[-1])
+    return order[left], order[right], weight, outside
+
+
+def resample_spectra(xdata: np.ndarray, data, grid: np.ndarray, memory_limit: int = CHUNK_MEMORY_LIMIT, extrapolate: bool = False,
+                     dtype=None):
+    # 最後の軸のスペクトルをgrid上に線形補間する．全点で同じ重みを使うので1回の演算でまとめて処理できる
+    # xdataは昇順でも降順でもよい．gridのうちxdataの範囲外の点はnan（extrapolate=Trueなら端の値）にする
+    # xdataが (行数, チャンネル) なら行ごとに別の横軸とみなす（ドリフト補正）．dataは (行数, 列数, スペクトル)
+    # (x, y, スペクトル) のデータは空間方向に分割し，一時配列をmemory_limit程度に抑える
+    xdata = np.asarray(xdata, dtype=float)
+    grid = np.asarray(grid, dtype=float)
+    # 重みは (行数または1, 1, grid) の形にして，全点に放送する
+    weights = [_interpolation_weights(x, grid, extrapolate) for x in xdata.reshape(-1, xdata.shape[-1])]
+    left, right, weight, outside = (np.stack(w)[:, np.newaxis, :] for w in zip(*weights))
+
+    # 1点，または (点数, スペクトル) のデータも (x, y, スペクトル) として扱う
+    view = data if data.ndim == 3 else data.reshape((1,) * (3 - data.ndim) + data.shape)
+    dtype = float_dtype(dtype)
+    result = np.empty(view.shape[:2] + grid.shape, dtype=dtype)
+    bytes_per_pixel = (view.shape[2] + 3 * len(grid)) * dtype.itemsize
+    for sx, sy in _spatial_chunks(view.shape, bytes_per_pixel, memory_limit):
+        rows = slice(None) if xdata.ndim == 1 else sx
+        chunk = view[sx, sy]
+        np.multiply(np.take_along_axis(chunk, left[rows], axis=-1), 1 - weight[rows], out=result[sx, sy])
+        result[sx, sy] += np.take_along_axis(chunk, right[rows], axis=-1) * weight[rows]
+        result[sx, sy][np.broadcast_to(outside[rows], result[sx, sy].shape)] = np.nan
+    return result.reshape(data.shape[:-1] + grid.shape)
+
+
+class ResampledSpectra:
+    # (行, 列, スペクトル) のdataを行ごとの横軸xdataからgrid上に補間したもの（resample_spectraと同じ値）を，
+    # 読み出した部分だけ計算して返す．ディスク上のデータのドリフト補正で，全体の配列をメモリに作らずに済む
+    # キーは [行, 列, チャンネル] の形（整数，slice，保存時の点の集まり）に限る
+    def __init__(self, xdata: np.ndarray, data, grid: np.ndarray, extrapolate: bool = False, dtype=None):
+        xdata = np.asarray(xdata, dtype=float)
+        grid = np.asarray(grid, dtype=float)
+        self.data = data
+        self.row_dependent = xdata.ndim == 2
+        weights = [_interpolation_weights(x, grid, extrapolate) for x in xdata.reshape(-1, xdata.shape[-1])]
+        self.left, self.right, self.weight, self.outside = (np.stack(w)[:, np.newaxis, :] for w in zip(*weights))
+        self.shape = data.shape[:2] + grid.shape
+        self.ndim = 3
+        self.dtype = float_dtype(dtype)
+        self.nbytes = 0  # dataと別にメモリは持たない
+
+    def __array__(self, dtype=None, copy=None):
+        raise TypeError('ResampledSpectra is read part by part; index it like [row, col] instead of converting it to an array.')
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        row, col, channel = key + (slice(None),) * (3 - len(key))
+        if np.ndim(row) == 1 and np.ndim(col) == 1:  # 点の集まり（保存時など）
+            return np.array([self[r, c, channel] for r, c in zip(row, col)])
+        # 整数は長さ1のsliceとして読み，最後に軸を落とす
+        drop = tuple(i for i, k in enumerate((row, col)) if isinstance(k, (int, np.integer)))
+        row, col = (slice(k, k + 1 or None) if isinstance(k, (int, np.integer)) else k for k in (row, col))
+        channels = np.arange(self.shape[2])[channel]
+        rows = row if self.row_dependent else slice(None)
+        left, right, weight, outside = (a[rows][..., np.atleast_1d(channels)] for a in (self.left, self.right, self.weight, self.outside))
+        # 補間に使う両隣のチャンネルの範囲だけ読む
+        lo = int(min(left.min(), right.min()))
+        hi = int(max(left.max(), right.max())) + 1
+        chunk = self.data[row, col, lo:hi]
+        result = np.take_along_axis(chunk, left - lo, axis=-1) * (1 - weight)
+        result += np.take_along_axis(chunk, right - lo, axis=-1) * weight
+        result[np.broadcast_to(outside, result.shape)] = np.nan
+        result = result.astype(self.dtype, copy=False)
+        if np.ndim(channels) == 0:
+            result = result[..., 0]
+        return result.squeeze(axis=drop) if drop else result
+
+
+def interpolate_xdata(xdata_list: list, positions, n_rows: int) -> np.ndarray:
+    # 複数のリファレンスで補正した横軸を，それぞれを測定した位置（行）の間で線形補間する
+    # 最初・最後のリファレンスより外側の行はそのリファレンスの横軸を使う．(行数, チャンネル) を返す
+    positions = np.asarray(positions, dtype=float)
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    xdata = np.asarray(xdata_list, dtype=float)[order]
+    if len(positions) == 1:
+        return np.repeat(xdata, n_rows, axis=0)
+    rows = np.arange(n_rows)
+    right = np.clip(np.searchsorted(positions, rows, side='right'), 1, len(positions) - 1)
+    left = right - 1
+    dp = positions[right] - positions[left]
+    weight = np.clip(np.divide(rows - positions[left], dp, out=np.zeros(n_rows), where=dp != 0), 0, 1)[:, np.newaxis]
+    return xdata[left] * (1 - weight) + xdata[right] * weight
 
 
 def column_to_row(data: np.ndarray):
     # change data from column major to row major
-    data_new = np.zeros_like(data)
-    for i1 in range(data.shape[0]):
-        for j1 in range(data.shape[1]):
-            index = i1 * data.shape[1] + j1
-            i2 = index % data.shape[0]
-            j2 = index // data.shape[0]
-            data_new[i2, j2] = data[i1, j1]
-    return data_new
+    # 先頭2軸をC順に並べた番号が，変換後の配列をFortran順に並べた番号になる
+    # reshapeとswapaxesだけなので，dataがC連続ならコピーせずビューを返す
+    n0, n1 = data.shape[:2]
+    return data.reshape(n1, n0, *data.shape[2:]).swapaxes(0, 1)
+
+
+def natural_key(name: str) -> list:
+    # ファイル名を，中の数字は数として比べる（ref_2 < ref_10）ためのキー
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
 
 
 def is_num(s):